@@ -1,43 +1,78 @@
+import random
 import logging
+import itertools
+import urllib.parse
 
 from celery import exceptions
 
-from .log_context import log_context
+from utils.log_context import log_context
 
 log = logging.getLogger(__name__)
 
 
 class TracingMixin:
+    """
+    Propagates log context to tasks in message headers and logs task start and finish.
+
+    `log_context_keys` - context keys to propagate (all keys if None), `trace_id` is always propagated
+    and `request_id` is always propagated as `parent_request_id`.
+    `log_context_compact` - send context as one `k1=v1&k2=v2` string in `x_log_ctx` header instead of dict,
+    values are propagated as strings.
+    `log_task_start_finish` - sample rate of "Task started/finished" log lines (0 disables them).
+    """
+
+    log_context_keys = None
+    log_context_compact = False
+    log_task_start_finish = 1.0
+
     def apply_async(self, *args, **kwargs):
-        from .log_context import context
+        from utils.log_context import context, _context
 
         headers = kwargs.get('headers') or {}
         kwargs['headers'] = headers
 
         ctx = headers.get('x-log-context', {})
-        headers['x_log_context'] = ctx
 
-        for k, v in context:
-            ctx[k] = v
+        if self.log_context_keys is None:
+            ctx.update(context)
+        else:
+            ctx_dict = _context.__dict__
+            for k in itertools.chain(self.log_context_keys, ('trace_id', 'request_id')):
+                try:
+                    ctx[k] = ctx_dict[k]
+                except KeyError:
+                    pass
 
         try:
-            ctx['parent_request_id'] = ctx['request_id']
-            del ctx['request_id']
+            ctx['parent_request_id'] = ctx.pop('request_id')
         except KeyError:
             pass
 
+        if self.log_context_compact:
+            headers['x_log_ctx'] = encode_log_context(ctx)
+        else:
+            headers['x_log_context'] = ctx
+
         return super().apply_async(*args, **kwargs)
 
     def __call__(self, *args, **kwargs):
-        ctx = self.request.get('x_log_context', {})
+        compact_ctx = self.request.get('x_log_ctx')
+        if compact_ctx is not None:
+            ctx = decode_log_context(compact_ctx)
+        else:
+            ctx = self.request.get('x_log_context', {})
 
         if self.request.id:
             ctx['request_id'] = self.request.id.replace('-', '')
             if not ctx.get('trace_id'):
                 ctx['trace_id'] = ctx['request_id']
 
+        sample_rate = self.log_task_start_finish
+        log_start_finish = sample_rate >= 1 or (sample_rate > 0 and random.random() < sample_rate)
+
         with log_context(**ctx):
-            log.info('Task %s started', self.name)
+            if log_start_finish:
+                log.info('Task %s started', self.name)
 
             try:
                 ret = super().__call__(*args, **kwargs)
@@ -46,11 +81,34 @@ class TracingMixin:
                     log.exception('Unhandled exception in task %s', self.name)
                 raise
             else:
-                log.info('Task %s finished', self.name)
+                if log_start_finish:
+                    log.info('Task %s finished', self.name)
 
             return ret
 
 
+def encode_log_context(ctx):
+    """
+    Encodes as `k1=v1&k2=v2`, only `%` and `&` are escaped in values (keys are identifiers).
+    """
+    return '&'.join(f'{k}={_escape_value(str(v))}' for k, v in ctx.items())
+
+
+def decode_log_context(value):
+    ctx = {}
+    if value:
+        for item in value.split('&'):
+            k, _, v = item.partition('=')
+            ctx[k] = urllib.parse.unquote(v) if '%' in v else v
+    return ctx
+
+
+def _escape_value(value):
+    if '%' in value or '&' in value:
+        return value.replace('%', '%25').replace('&', '%26')
+    return value
+
+
 class TimeLimitPropertiesMixin:
     @property
     def effective_soft_time_limit(self):
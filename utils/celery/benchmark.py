@@ -0,0 +1,81 @@
+"""
+Micro-benchmark of `TracingMixin` overhead per `apply_async` and per task call (no broker involved)
+and size of propagated headers in JSON.
+
+    python -m utils.celery.benchmark [--iterations 100000] [--context-size 10]
+"""
+import os
+import json
+import uuid
+import logging
+import argparse
+import timeit
+
+from utils.celery import TracingMixin
+from utils.log_context import log_context
+
+
+class Request(dict):
+    def __getattr__(self, item):
+        return self.get(item)
+
+
+class DummyTask:
+    name = 'benchmark'
+
+    def __init__(self):
+        self.request = Request()
+
+    def apply_async(self, args=None, kwargs=None, **options):
+        return options
+
+    def __call__(self, *args, **kwargs):
+        return None
+
+
+def make_task_class(**options):
+    return type('BenchmarkTask', (TracingMixin, DummyTask), options)
+
+
+def bench(task_class, iterations, context):
+    task = task_class()
+
+    with log_context(**context):
+        apply_time = timeit.timeit(lambda: task.apply_async((1,)), number=iterations)
+        headers = task.apply_async((1,))['headers']
+    headers_size = len(json.dumps(headers))
+
+    task.request = Request(headers, id=str(uuid.uuid4()))
+    call_time = timeit.timeit(lambda: task(1), number=iterations)
+
+    return apply_time / iterations, call_time / iterations, headers_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=100000)
+    parser.add_argument('--context-size', type=int, default=10)
+    args = parser.parse_args()
+
+    # logging to /dev/null still formats records, as real handlers do
+    handler = logging.StreamHandler(open(os.devnull, 'w'))
+    logging.basicConfig(level=logging.INFO, handlers=[handler])
+
+    context = {f'var{i}': uuid.uuid4().hex for i in range(args.context_size)}
+    context.update(request_id=uuid.uuid4().hex, trace_id=uuid.uuid4().hex)
+
+    configs = {
+        'default': {},
+        'whitelist': {'log_context_keys': ('trace_id',)},
+        'whitelist+compact': {'log_context_keys': ('trace_id',), 'log_context_compact': True},
+        'whitelist+compact+1% logs': {'log_context_keys': ('trace_id',), 'log_context_compact': True,
+                                      'log_task_start_finish': 0.01},
+    }
+    for name, options in configs.items():
+        apply_time, call_time, headers_size = bench(make_task_class(**options), args.iterations, context)
+        print(f'{name:>26}: apply_async {apply_time * 1e6:.2f} us, call {call_time * 1e6:.2f} us, '
+              f'headers {headers_size} bytes')
+
+
+if __name__ == '__main__':
+    main()
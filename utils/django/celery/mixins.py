@@ -1,9 +1,30 @@
+import json
+import logging
+import weakref
+import functools
+import threading
+
+from celery import signals
 from django.db import transaction
 from django.db import DEFAULT_DB_ALIAS
 
+from utils import chunks
+from utils.queue_worker import BatchQueueWorkerThread
+
+log = logging.getLogger(__name__)
+_local = threading.local()
+_batch_workers = weakref.WeakSet()
+
 
 class PostTransactionMixin:
+    """
+    Postpones publishing till transaction commit.
+    With `deduplicate_on_commit` identical calls (same task, arguments and options) within transaction
+    are published once.
+    """
+
     using = DEFAULT_DB_ALIAS
+    deduplicate_on_commit = False
 
     def apply_async(self, *args, **kwargs):
         original_apply_async = super().apply_async
@@ -12,6 +33,10 @@ class PostTransactionMixin:
             celery_eager = self.app.conf.task_always_eager
             connection = transaction.get_connection(using=self.using)
             if connection.in_atomic_block and not celery_eager:
+                if self.deduplicate_on_commit:
+                    publisher = OnCommitPublisher.get(self.using)
+                    publish = functools.partial(publisher.publish, self.name, original_apply_async, args, kwargs)
+                    return transaction.on_commit(publish, using=self.using)
                 return transaction.on_commit(lambda: original_apply_async(*args, **kwargs), using=self.using)
 
         return original_apply_async(*args, **kwargs)
@@ -31,3 +56,162 @@ class AtomicMixin:
                 return super().__call__(*args, **kwargs)
         else:
             return super().__call__(*args, **kwargs)
+
+
+class BatchingMixin:
+    """
+    Buffers task calls and publishes them as one message with list of `[args, kwargs]` calls,
+    the task function receives this list as the only argument and runs once per batch
+    (inside one transaction if `atomic` is set, see `AtomicMixin`).
+
+    Calls made while worker executes a task are buffered till the task returns (`task_postrun`)
+    and published from the worker thread. Other calls are buffered in background thread for up to
+    `batch_timeout` seconds, it's drained at exit and on `worker_process_shutdown`.
+    Calls are published in batches of up to `batch_size` calls, calls made inside transaction are buffered
+    after commit (calls of rolled back savepoints are discarded).
+    Buffered calls are lost if process is killed (e.g. hard time limit or SIGKILL).
+    Calls with options other than `headers` (e.g. `countdown`) are published immediately as batch of one call.
+    Batch messages are marked with `x_batch` header, calls having it (e.g. retries) are published as is.
+    Headers (log context) of the first call are used for the whole batch.
+    `apply_async` returns None for buffered calls.
+    """
+
+    using = DEFAULT_DB_ALIAS
+    batch_size = 100
+    batch_timeout = 1
+    batch_header = 'x_batch'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._batch_worker = None
+        self._batch_worker_lock = threading.Lock()
+
+    def apply_async(self, args=None, kwargs=None, **options):
+        headers = options.pop('headers', None)
+        if headers and headers.get(self.batch_header):
+            # already a batch: retry or signature of published message
+            return super().apply_async(args=args, kwargs=kwargs, headers=headers, **options)
+
+        call = [list(args or ()), kwargs or {}]
+        if options or self.app.conf.task_always_eager:
+            return super().apply_async(args=([call],), headers=self._make_batch_headers(headers), **options)
+
+        if self.using is not None:
+            connection = transaction.get_connection(using=self.using)
+            if connection.in_atomic_block:
+                transaction.on_commit(functools.partial(self._queue_call, call, headers), using=self.using)
+                return None
+
+        self._queue_call(call, headers)
+        return None
+
+    def _queue_call(self, call, headers):
+        if self.app.current_worker_task is not None:
+            # prefork children exit with os._exit, background thread wouldn't be drained
+            _get_task_buffer(self).add(call, headers)
+        else:
+            self._get_batch_worker().queue((call, headers))
+
+    def _get_batch_worker(self):
+        with self._batch_worker_lock:
+            if self._batch_worker is None:
+                self._batch_worker = BatchQueueWorkerThread(
+                    self._publish_queued_batch, batch_size=self.batch_size, batch_timeout=self.batch_timeout,
+                    thread_name=f'BatchingMixin-{self.name}')
+                _batch_workers.add(self._batch_worker)
+            return self._batch_worker
+
+    def _publish_queued_batch(self, items):
+        calls = [call for call, _ in items]
+        self.publish_batch(calls, items[0][1])
+
+    def _make_batch_headers(self, headers):
+        return dict(headers or {}, **{self.batch_header: True})
+
+    def publish_batch(self, calls, headers=None):
+        headers = self._make_batch_headers(headers)
+        for batch in chunks(calls, self.batch_size):
+            super().apply_async(args=(batch,), headers=headers)
+
+
+class TaskBatchBuffer:
+    """
+    Calls of one batching task made while worker executes a task, published when `batch_size` calls
+    are collected and on `task_postrun`.
+    """
+
+    def __init__(self, task):
+        self.task = task
+        self.calls = []
+        self.headers = None
+
+    def add(self, call, headers):
+        if not self.calls:
+            self.headers = headers
+        self.calls.append(call)
+        if len(self.calls) >= self.task.batch_size:
+            self.flush()
+
+    def flush(self):
+        calls, self.calls = self.calls, []
+        if calls:
+            self.task.publish_batch(calls, self.headers)
+
+
+def _get_task_buffer(task):
+    buffers = _local.__dict__.setdefault('task_buffers', {})
+    buffer = buffers.get(task.name)
+    if buffer is None:
+        buffer = buffers[task.name] = TaskBatchBuffer(task)
+    return buffer
+
+
+@signals.task_postrun.connect
+def flush_task_batches(**kwargs):
+    buffers = _local.__dict__.pop('task_buffers', None)
+    for buffer in (buffers or {}).values():
+        try:
+            buffer.flush()
+        except Exception:
+            log.exception('Failed to publish batch of %s', buffer.task.name)
+
+
+@signals.worker_process_shutdown.connect
+def drain_batch_workers(**kwargs):
+    flush_task_batches()
+    for worker in list(_batch_workers):
+        worker.main_thread_terminated()
+
+
+class OnCommitPublisher:
+    """
+    Publishes calls of tasks with `deduplicate_on_commit` from `on_commit` hooks of one transaction,
+    calls identical to already published ones are skipped.
+    Hooks of rolled back savepoints are discarded by Django, so their calls don't suppress other ones.
+    """
+
+    def __init__(self):
+        self.published = set()
+        self.committed = False
+
+    @classmethod
+    def get(cls, using):
+        publishers = _local.__dict__.setdefault('publishers', {})
+        publisher = publishers.get(using)
+        if publisher is None or publisher.committed:
+            # publisher of rolled back transaction has published nothing, so it can be reused
+            publisher = publishers[using] = cls()
+        return publisher
+
+    def publish(self, task_name, apply_async, args, kwargs):
+        # hooks run after commit, calls of the next transaction go to a new publisher
+        self.committed = True
+        key = self.make_key(task_name, args, kwargs)
+        if key not in self.published:
+            self.published.add(key)
+            apply_async(*args, **kwargs)
+
+    @staticmethod
+    def make_key(task_name, args, kwargs):
+        options = {name: value for name, value in kwargs.items() if name != 'headers'}
+        return json.dumps([task_name, args, options], sort_keys=True, default=repr)
@@ -7,10 +7,10 @@ from celery import Task as BaseTask
 from django.conf import settings
 
 from utils.celery import TracingMixin, TimeClaimingMixin, TaskModuleNamingMixin
-from .mixins import PostTransactionMixin, AtomicMixin
+from .mixins import PostTransactionMixin, AtomicMixin, BatchingMixin
 from .sentry import install_sentry_signals
 
-__all__ = ['Celery', 'app', 'Task', 'task']
+__all__ = ['Celery', 'app', 'Task', 'task', 'BatchTask', 'batch_task']
 
 
 class Celery(TaskModuleNamingMixin, BaseCelery):
@@ -35,6 +35,13 @@ class Task(TracingMixin, PostTransactionMixin, TimeClaimingMixin, AtomicMixin, B
 task = partial(app.task, base=Task, ignore_result=True)
 
 
+class BatchTask(TracingMixin, BatchingMixin, PostTransactionMixin, TimeClaimingMixin, AtomicMixin, BaseTask):
+    atomic = True
+
+
+batch_task = partial(app.task, base=BatchTask, ignore_result=True)
+
+
 warnings.filterwarnings('ignore', module='celery.fixups.django',
                         message=r'.*\bsettings.DEBUG\b.*')
 
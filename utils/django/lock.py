@@ -0,0 +1,19 @@
+from django.core.cache import cache as django_cache
+
+from utils.lock.backends import LockBackend
+from utils.redis import get_redis_connection, get_async_redis_connection
+
+
+class DjangoCacheBackend(LockBackend):
+    """
+    Uses Redis client and key function of default Django cache (django-redis).
+    """
+
+    def get_client(self):
+        return get_redis_connection()
+
+    def get_async_client(self):
+        return get_async_redis_connection()
+
+    def make_key(self, key):
+        return django_cache.make_key(key)
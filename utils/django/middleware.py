@@ -20,6 +20,20 @@ def add_trace_id_response_header(get_response):
     return middleware
 
 
+def set_route_template(get_response):
+    """
+    Puts route template of matched URL pattern into WSGI environ for latency metrics of `IdleCounter`.
+    """
+
+    def middleware(request):
+        response = get_response(request)
+        resolver_match = request.resolver_match
+        if resolver_match is not None:
+            request.environ['_smp_route'] = resolver_match.route
+        return response
+    return middleware
+
+
 class LogRequestMiddleware:
     _sanitized_value = '***'
     _sanitizeable_keys = {'password', 'token', }
@@ -97,6 +97,7 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'utils.django.middleware.LogRequestMiddleware',
     'utils.django.middleware.add_trace_id_response_header',
+    'utils.django.middleware.set_route_template',
 ]
 
 APPEND_SLASH = False
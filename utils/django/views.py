@@ -11,6 +11,7 @@ from rest_framework import schemas
 from rest_framework.response import Response
 from rest_framework.schemas.openapi import AutoSchema
 
+from utils.wsgi.middeware.idle_counter import MetricsExposition, accepts_gzip
 from .renderers import OpenAPIRenderer
 
 log = logging.getLogger(__name__)
@@ -98,16 +99,12 @@ class HealthzView(views.APIView):
 
 class MetriczView(views.View):
     def get(self, request, *args, **kwargs):
-        response = HttpResponse()
-        response.headers['Content-Type'] = 'text/plain'
-        response.content = '\n'.join(self.format_metrics()).encode('utf8')
-        return response
-
-    def format_metrics(self):
-        idle_counter = self.request.META.get('_smp_idle_counter')
+        response = HttpResponse(content_type=MetricsExposition.content_type)
+        idle_counter = request.META.get('_smp_idle_counter')
         if idle_counter:
-            yield '# TYPE idle_seconds_total summary'
-            yield '# TYPE busy_seconds_total summary'
-            for metrics in idle_counter.read_metrics():
-                metric_name = f'{metrics.metric_type}_seconds_total'
-                yield f'{metric_name}{{pid="{metrics.pid}",tid="{metrics.tid}"}} {metrics.idle_seconds_total}'
+            use_gzip = accepts_gzip(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+            response.content = idle_counter.exposition.get(use_gzip)
+            response.headers['Vary'] = 'Accept-Encoding'
+            if use_gzip:
+                response.headers['Content-Encoding'] = 'gzip'
+        return response
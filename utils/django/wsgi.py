@@ -24,7 +24,10 @@ def get_wsgi_application(preinit=default_behaviour):
         prometheus_metrics_port = getattr(settings, 'PROMETHEUS_METRICS_PORT', None)
         if prometheus_metrics_port:
             prometheus_metrics_address = ('', prometheus_metrics_port)
-        app = idle_counter = IdleCounter(app, prometheus_metrics_address=prometheus_metrics_address)
+        app = idle_counter = IdleCounter(
+            app, prometheus_metrics_address=prometheus_metrics_address,
+            shared_memory=getattr(settings, 'IDLE_COUNTER_SHARED_MEMORY', False),
+            shed_utilization=getattr(settings, 'IDLE_COUNTER_SHED_UTILIZATION', None))
         app = set_environ(app, _smp_idle_counter=idle_counter)
 
     if preinit is default_behaviour:
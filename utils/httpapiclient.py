@@ -1,20 +1,60 @@
+import time
 import contextlib
 
-from utils.lock import DistributedLockingRateLimiter
+from utils.lock import DistributedLockingRateLimiter, FairDistributedLockingRateLimiter, get_time_frames
+from utils.metrics import Histogram
 
 
 class RateLimitMixin:
+    """
+    `rate_limits` is a list of (rate_hz, limiter_name) pairs.
+    Time waited for each limit is observed in `rate_limit_wait_histograms[limiter_name]`.
+
+    With `rate_limit_fair` limits are `FairDistributedLockingRateLimiter` (FIFO waiters),
+    time frames of all limits are reserved with one Redis round-trip per request.
+    Fair limiters use other Redis keys, so they don't exclude clients with `rate_limit_fair` off:
+    switch all clients of a limit at once.
+    """
+
+    rate_limit_fair = False
+    rate_limit_wait_buckets = Histogram.default_buckets
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.rate_limits = []
+        self.rate_limit_wait_histograms = {}
+        self._rate_limiters = {}
+
+    def _get_rate_limiters(self):
+        limiter_class = FairDistributedLockingRateLimiter if self.rate_limit_fair else DistributedLockingRateLimiter
+        limiters = []
+        for rate_hz, limiter_name in self.rate_limits:
+            limiter = self._rate_limiters.get(limiter_name)
+            if not isinstance(limiter, limiter_class):
+                limiter = self._rate_limiters[limiter_name] = limiter_class(rate_hz, limiter_name)
+                self.rate_limit_wait_histograms.setdefault(limiter_name, Histogram(self.rate_limit_wait_buckets))
+            if limiter.max_rate_hz != rate_hz:
+                limiter.max_rate_hz = rate_hz
+            limiters.append(limiter)
+        return limiters
 
     def _request_once(self, *args, **kwargs):
-        # TODO: optimize
-        rate_limiters = (DistributedLockingRateLimiter(rate_hz, limiter_name)
-                         for rate_hz, limiter_name in self.rate_limits)
-        ctx_managers = (limiter.get_time_frame() for limiter in rate_limiters)
+        limiters = self._get_rate_limiters()
+
+        if self.rate_limit_fair:
+            with get_time_frames(limiters) as waits:
+                self._observe_rate_limit_waits(limiters, waits)
+                return super()._request_once(*args, **kwargs)
 
         with contextlib.ExitStack() as stack:
-            for ctx in ctx_managers:
-                stack.enter_context(ctx)
+            waits = []
+            for limiter in limiters:
+                started_at = time.monotonic()
+                stack.enter_context(limiter.get_time_frame())
+                waits.append(time.monotonic() - started_at)
+            self._observe_rate_limit_waits(limiters, waits)
             return super()._request_once(*args, **kwargs)
+
+    def _observe_rate_limit_waits(self, limiters, waits):
+        for limiter, wait in zip(limiters, waits):
+            self.rate_limit_wait_histograms[limiter.name].observe(wait)
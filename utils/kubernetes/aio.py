@@ -0,0 +1,177 @@
+"""
+Asyncio version of `KubeWatcher` built on kubernetes_asyncio.
+Many resources can be watched in one thread with `MultiplexedWatcher`, list functions of all watchers
+should be bound to one `kubernetes_asyncio.client.ApiClient`, so they share its connection pool.
+"""
+import json
+import asyncio
+import logging
+
+import kubernetes_asyncio
+
+from .watch import KubeWatcher, WatchEventType, RestartWatchException
+
+log = logging.getLogger(__name__)
+
+
+class AsyncKubeWatcher(KubeWatcher):
+    """
+    Same as `KubeWatcher`, but `list_func` is a kubernetes_asyncio API method, use `async for`.
+    Lists pages asynchronously, so `handle_initial` and `handle_restart` are not called,
+    objects go through the same per-object hooks (`handle_initial_object`, `handle_restart_object`).
+    """
+
+    def __iter__(self):
+        raise TypeError('Use async for')
+
+    def _get_api_client(self):
+        # creating kubernetes_asyncio client opens a session, so use the one `list_func` is bound to
+        return self.list_func.__self__.api_client
+
+    async def __aiter__(self):
+        resume = False
+        if self._should_load_snapshot():
+            # reading and deserializing snapshot blocks for a while, don't stall other watchers of the loop
+            resume = await asyncio.get_running_loop().run_in_executor(None, self.load_snapshot)
+            if resume:
+                for event in self._replay_snapshot():
+                    yield event
+
+        while True:
+            try:
+                if resume:
+                    resume = False
+                    async for event in self._watch_async():
+                        yield event
+
+                if self._initial_done:
+                    self.relist_count += 1
+
+                if not self.db:
+                    async for obj in self._depaginate_async():
+                        yield self.handle_initial_object(obj)
+                else:
+                    # also when initial listing has been interrupted
+                    async for event in self._handle_restart_async():
+                        yield event
+
+                if not self._initial_done:
+                    self._initial_done = True
+                    yield WatchEventType.DONE_INITIAL, None
+
+                self.resource_version = self._list_resource_version
+                async for event in self._watch_async():
+                    yield event
+            except RestartWatchException:
+                pass
+
+    async def _watch_async(self):
+        while True:
+            async for event in self._safe_stream_async():
+                event_type, obj = self._process_watch_event(event)
+                if event_type != WatchEventType.BOOKMARK:
+                    yield event_type, obj
+                if self._is_snapshot_due():
+                    await asyncio.get_running_loop().run_in_executor(None, self._safe_save_snapshot)
+            self.reconnect_count += 1
+
+    async def _handle_restart_async(self):
+        alive_uids = set()
+
+        async for obj in self._depaginate_async():
+            event = self.handle_restart_object(obj, alive_uids)
+            if event is not None:
+                yield event
+
+        for event in self.handle_restart_deleted(alive_uids):
+            yield event
+
+    async def _list_page_async(self, continue_token=None):
+        kwargs = self._get_list_kwargs(continue_token)
+        try:
+            if self.raw:
+                response = await self.list_func(_preload_content=False, **kwargs)
+                return json.loads(await response.read())
+            return await self.list_func(**kwargs)
+        except kubernetes_asyncio.client.ApiException as e:
+            if e.status == 410 and continue_token:
+                log.debug('List continue token has expired. Restarting the list')
+                raise RestartWatchException() from e
+            raise
+
+    async def _depaginate_async(self):
+        continue_token = None
+        while True:
+            obj_list = await self._list_page_async(continue_token)
+            items, continue_token = self._read_page(obj_list)
+            for obj in items:
+                yield obj
+            if not continue_token:
+                break
+
+    async def _safe_stream_async(self):
+        w = AsyncRawWatch() if self.raw else kubernetes_asyncio.watch.Watch()
+        try:
+            async with w.stream(self.list_func, **self._get_watch_kwargs()) as stream:
+                async for event in stream:
+                    if event['type'] == WatchEventType.ERROR.value and _is_gone(event):
+                        raise RestartWatchException()
+                    yield event
+        except asyncio.TimeoutError:
+            log.debug('Watch timeout')
+        except kubernetes_asyncio.client.ApiException as e:
+            if e.status != 410:
+                raise
+            log.debug('The resourceVersion for provided watch is too old. Restarting the watch')
+            raise RestartWatchException() from e
+        else:
+            log.debug('Watch connection closed')
+
+
+class AsyncRawWatch(kubernetes_asyncio.watch.Watch):
+    def get_return_type(self, func):
+        return None
+
+
+class MultiplexedWatcher:
+    """
+    Runs many `AsyncKubeWatcher` concurrently and yields merged stream of `(name, event_type, obj)`.
+    `DONE_INITIAL` is yielded for every watcher separately.
+    """
+
+    def __init__(self, watchers, queue_size=1000):
+        """
+        :param watchers:  dict of resource name => `AsyncKubeWatcher`
+        """
+        self.watchers = dict(watchers)
+        self.queue_size = queue_size
+
+    async def __aiter__(self):
+        queue = asyncio.Queue(self.queue_size)
+        tasks = [asyncio.create_task(self._pump(name, watcher, queue)) for name, watcher in self.watchers.items()]
+        try:
+            while True:
+                item = await queue.get()
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    @staticmethod
+    async def _pump(name, watcher, queue):
+        try:
+            async for event_type, obj in watcher:
+                await queue.put((name, event_type, obj))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.exception('Watcher %s failed', name)
+            await queue.put(e)
+
+
+def _is_gone(event):
+    obj = event.get('raw_object') or event['object']
+    return isinstance(obj, dict) and obj.get('code') == 410
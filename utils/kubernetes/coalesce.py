@@ -0,0 +1,98 @@
+import logging
+import threading
+import collections
+
+from utils.lock import LocalRateLimiter
+from .watch import WatchEventType, get_uid
+
+log = logging.getLogger(__name__)
+
+_done_initial_key = object()
+
+
+class CoalescingWatcher:
+    """
+    Workqueue-like layer on top of `KubeWatcher`: watcher is consumed in background thread,
+    only the latest state of every object (by uid) waits for delivery, events are delivered
+    in order objects became dirty, at most `max_rate_hz` events (or batches) per second.
+
+    Pending events of one object are merged: ADDED + MODIFIED => ADDED, MODIFIED + DELETED => DELETED,
+    ADDED + DELETED => nothing. DONE_INITIAL is delivered after all events that were pending before it.
+    """
+
+    def __init__(self, watcher, max_rate_hz=None):
+        self.watcher = watcher
+        self.rate_limiter = LocalRateLimiter(max_rate_hz) if max_rate_hz else None
+        self.pending = collections.OrderedDict()
+        self.received_count = 0
+        self.delivered_count = 0
+        self._cond = threading.Condition()
+        self._error = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='CoalescingWatcher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        try:
+            for event_type, obj in self.watcher:
+                with self._cond:
+                    self._add(event_type, obj)
+                    self.received_count += 1
+                    self._cond.notify()
+        except Exception as e:
+            log.exception('Watcher failed')
+            with self._cond:
+                self._error = e
+                self._cond.notify()
+
+    def _add(self, event_type, obj):
+        if event_type == WatchEventType.DONE_INITIAL:
+            self.pending[_done_initial_key] = (event_type, obj)
+            return
+
+        uid = get_uid(obj)
+        pending = self.pending.get(uid)
+        if pending is None:
+            self.pending[uid] = (event_type, obj)
+            return
+
+        pending_type = pending[0]
+        if pending_type == WatchEventType.ADDED and event_type == WatchEventType.DELETED:
+            del self.pending[uid]
+        elif pending_type == WatchEventType.ADDED:
+            self.pending[uid] = (WatchEventType.ADDED, obj)
+        else:
+            self.pending[uid] = (event_type, obj)
+
+    def _take(self, max_count):
+        with self._cond:
+            while not self.pending:
+                if self._error is not None:
+                    raise self._error
+                self._cond.wait()
+
+            events = []
+            while self.pending and len(events) < max_count:
+                events.append(self.pending.popitem(last=False)[1])
+            self.delivered_count += len(events)
+            return events
+
+    def __iter__(self):
+        self.start()
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.wait()
+            yield from self._take(1)
+
+    def iter_batches(self, batch_size=100):
+        """
+        Yields lists of up to `batch_size` events.
+        """
+        self.start()
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.wait()
+            yield self._take(batch_size)
@@ -1,6 +1,15 @@
+import os
+import re
 import enum
+import json
+import time
+import zlib
 import random
 import logging
+import tempfile
+import functools
+import collections
+import types
 
 import kubernetes
 from urllib3.exceptions import ReadTimeoutError
@@ -22,42 +31,229 @@ class WatchEventType(enum.Enum):
 class KubeWatcher:
     min_watch_timeout = 5 * 60
 
-    def __init__(self, list_func, namespace=None):
+    def __init__(self, list_func, namespace=None, page_size=500, projection=None, raw=False, indexes=None,
+                 snapshot_path=None, snapshot_interval=60):
+        """
+        :param page_size:   objects per list request, list is not paginated if None
+        :param projection:  what to store in `db` instead of whole objects: callable `projection(obj)`
+                            or list of JSON paths (e.g. `['metadata.name', 'spec.nodeName']`)
+                            for slotted `KubeObjectRecord`; resource versions of projected objects are kept
+                            in `resource_versions`, DELETED events found on relist yield stored projections
+        :param raw:         don't deserialize objects to kubernetes models, yield dicts parsed from JSON
+        :param indexes:     dict of index name => function returning iterable of index values of object,
+                            see `index_by_namespace`, `index_by_labels`, `index_by_owner_uid`
+        :param snapshot_path:      file to save `db` and `resource_version` to every `snapshot_interval` seconds
+                                   as compressed JSON, on start objects are loaded from it and yielded as ADDED
+                                   (projections if `projection` is set, same as `db` values)
+                                   and watch is resumed without relist;
+                                   values of callable projection must be JSON-serializable,
+                                   models and datetimes in projections are restored in their JSON form
+        """
         self.list_func = list_func
         self.namespace = namespace
+        self.page_size = page_size
+        self.raw = raw
+        if projection is None or callable(projection):
+            self.projection = projection
+        else:
+            self.projection = make_projection(projection)
+        self.indexer = Indexer(indexes or {})
         self.resource_version = None
         self.db = {}
+        self.resource_versions = {}
+        self._initial_done = False
+        self._list_resource_version = None
+        self.relist_count = 0
+        self.reconnect_count = 0
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self._snapshot_saved_at = time.monotonic()
 
     def __iter__(self):
+        resume = yield from self._resume_from_snapshot()
+
         while True:
             try:
-                if self.namespace is None:
-                    obj_list = self.list_func()
-                else:
-                    obj_list = self.list_func(namespace=self.namespace)
+                if resume:
+                    resume = False
+                    yield from self._watch()
+
+                if self._initial_done:
+                    self.relist_count += 1
+                obj_list = self._list_page()
 
-                if not self.resource_version:
+                if not self.db:
                     yield from self.handle_initial(obj_list)
-                    yield WatchEventType.DONE_INITIAL, None
                 else:
+                    # also when initial listing has been interrupted
                     yield from self.handle_restart(obj_list)
 
-                self.resource_version = obj_list.metadata.resource_version
-
-                while True:
-                    for event in self._safe_stream():
-                        try:
-                            event_type = WatchEventType(event['type'])
-                        except ValueError:
-                            raise Exception('Unknown event type: %s', event['type'])
-                        obj = event['object']
-                        self.handle_event(event_type, obj)
-                        self.resource_version = obj.metadata.resource_version
-                        yield event_type, obj
+                if not self._initial_done:
+                    self._initial_done = True
+                    yield WatchEventType.DONE_INITIAL, None
+
+                self.resource_version = self._list_resource_version
+                yield from self._watch()
             except RestartWatchException:
                 pass
 
-    def _safe_stream(self):
+    def _watch(self):
+        while True:
+            for event in self._safe_stream():
+                event_type, obj = self._process_watch_event(event)
+                if event_type != WatchEventType.BOOKMARK:
+                    yield event_type, obj
+                self._maybe_save_snapshot()
+            self.reconnect_count += 1
+
+    def _resume_from_snapshot(self):
+        """
+        Replays objects of snapshot as ADDED, returns True if watch can be resumed.
+        """
+        if not self._should_load_snapshot() or not self.load_snapshot():
+            return False
+
+        yield from self._replay_snapshot()
+        return True
+
+    def _should_load_snapshot(self):
+        return self.snapshot_path and not self._initial_done
+
+    def _replay_snapshot(self):
+        for obj in list(self.db.values()):
+            yield WatchEventType.ADDED, obj
+        self._initial_done = True
+        yield WatchEventType.DONE_INITIAL, None
+
+    def _is_snapshot_due(self):
+        return self.snapshot_path and time.monotonic() - self._snapshot_saved_at >= self.snapshot_interval
+
+    def _maybe_save_snapshot(self):
+        if self._is_snapshot_due():
+            self._safe_save_snapshot()
+
+    def _safe_save_snapshot(self):
+        try:
+            self.save_snapshot()
+        except Exception:
+            # retried on next interval, watching goes on
+            self._snapshot_saved_at = time.monotonic()
+            log.exception('Failed to save snapshot %s', self.snapshot_path)
+
+    def _get_api_client(self):
+        """
+        Client of `list_func` API, it (de)serializes models of snapshot.
+        """
+        api = getattr(self.list_func, '__self__', None)
+        if api is None:
+            return kubernetes.client.ApiClient()
+        return api.api_client
+
+    def save_snapshot(self):
+        """
+        Writes zlib-compressed JSON of `db`, index values and `resource_version`, replaces file atomically.
+        """
+        data = {
+            'version': 3,
+            'resource_version': self.resource_version,
+            'raw': self.raw,
+            'model': None,
+            'record_fields': self._get_record_fields(),
+            'db': self.db,
+            'resource_versions': self.resource_versions,
+            'index_values': {name: {uid: list(values) for uid, values in uid_values.items()}
+                             for name, uid_values in self.indexer.values.items()},
+        }
+        if data['record_fields'] is not None:
+            data['db'] = {uid: [record.resource_version] + [getattr(record, field) for field in record.fields]
+                          for uid, record in self.db.items()}
+        elif self.projection is None and not self.raw and self.db:
+            data['model'] = type(next(iter(self.db.values()))).__name__
+
+        api_client = None
+
+        def serialize(value):
+            nonlocal api_client
+            if api_client is None:
+                api_client = self._get_api_client()
+            return api_client.sanitize_for_serialization(value)
+
+        payload = zlib.compress(json.dumps(data, default=serialize).encode(), 1)
+
+        dirname = os.path.dirname(os.path.abspath(self.snapshot_path))
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.snapshot.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        self._snapshot_saved_at = time.monotonic()
+        log.debug('Saved snapshot of %d objects at version %s', len(self.db), self.resource_version)
+
+    def load_snapshot(self):
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                data = json.loads(zlib.decompress(f.read()))
+        except FileNotFoundError:
+            return False
+        except Exception:
+            log.warning('Failed to load snapshot %s', self.snapshot_path, exc_info=True)
+            return False
+
+        record_fields = self._get_record_fields()
+        if data.get('version') != 3 or data['raw'] != self.raw \
+                or data['record_fields'] != (list(record_fields) if record_fields is not None else None) \
+                or set(data['index_values']) != set(self.indexer.index_funcs):
+            log.info('Snapshot %s is incompatible, ignoring it', self.snapshot_path)
+            return False
+
+        try:
+            db = self._restore_db(data)
+        except Exception:
+            log.warning('Failed to restore objects of snapshot %s', self.snapshot_path, exc_info=True)
+            return False
+
+        self.db = db
+        self.resource_versions = data['resource_versions']
+        self.indexer.restore({name: {uid: frozenset(values) for uid, values in uid_values.items()}
+                              for name, uid_values in data['index_values'].items()})
+        self.resource_version = data['resource_version']
+        log.debug('Loaded snapshot of %d objects at version %s', len(self.db), self.resource_version)
+        return True
+
+    def _get_record_fields(self):
+        return getattr(self.projection, 'fields', None)
+
+    def _restore_db(self, data):
+        db = data['db']
+        if data['record_fields'] is not None:
+            record_class = get_record_class(tuple(data['record_fields']))
+            return {uid: record_class(uid, *values) for uid, values in db.items()}
+        if data['model'] is not None:
+            response = types.SimpleNamespace(data=json.dumps(list(db.values())))
+            objects = self._get_api_client().deserialize(response, f'list[{data["model"]}]')
+            return dict(zip(db, objects))
+        return db
+
+    def _process_watch_event(self, event):
+        try:
+            event_type = WatchEventType(event['type'])
+        except ValueError:
+            raise Exception('Unknown event type: %s', event['type'])
+        obj = event['object']
+        self.handle_event(event_type, obj)
+        self.resource_version = get_event_resource_version(event)
+        return event_type, obj
+
+    def _get_watch_kwargs(self):
         timeout = random.randint(self.min_watch_timeout, self.min_watch_timeout * 2)
 
         log.debug('Watching events since version %s, timeout %d seconds', self.resource_version, timeout)
@@ -65,14 +261,18 @@ class KubeWatcher:
         kwargs = {
             'timeout_seconds': timeout,
             '_request_timeout': timeout + 10,
+            # keeps resource_version fresh while there are no events, so reconnect doesn't get 410 Gone
+            'allow_watch_bookmarks': True,
         }
         if self.resource_version:
             kwargs['resource_version'] = self.resource_version
         if self.namespace is not None:
             kwargs['namespace'] = self.namespace
+        return kwargs
 
-        w = kubernetes.watch.Watch()
-        gen = w.stream(self.list_func, **kwargs)
+    def _safe_stream(self):
+        w = RawWatch() if self.raw else kubernetes.watch.Watch()
+        gen = w.stream(self.list_func, **self._get_watch_kwargs())
         while True:
             try:
                 val = next(gen)
@@ -86,13 +286,45 @@ class KubeWatcher:
                 # workaround for the bug https://github.com/kubernetes-client/python-base/issues/57
                 log.debug('The resourceVersion for provided watch is too old. Restarting the watch')
                 raise RestartWatchException()
+            except kubernetes.client.ApiException as e:
+                if e.status != 410:
+                    raise
+                log.debug('The resourceVersion for provided watch is too old. Restarting the watch')
+                raise RestartWatchException() from e
             yield val
 
+    def _store(self, uid, obj):
+        self.indexer.update(uid, obj)
+        if self.projection is None:
+            self.db[uid] = obj
+        else:
+            self.db[uid] = self.projection(obj)
+            self.resource_versions[uid] = get_resource_version(obj)
+
+    def _delete(self, uid):
+        self.indexer.remove(uid)
+        self.resource_versions.pop(uid, None)
+        return self.db.pop(uid)
+
+    def _get_stored_resource_version(self, uid):
+        if self.projection is None:
+            return get_resource_version(self.db[uid])
+        return self.resource_versions[uid]
+
+    def by_index(self, index_name, value):
+        """
+        Returns stored objects having `value` in index `index_name`.
+        """
+        return [self.db[uid] for uid in self.indexer.get_uids(index_name, value)]
+
     def handle_event(self, event_type, obj):
         if event_type in (WatchEventType.ADDED, WatchEventType.MODIFIED):
-            self.db[obj.metadata.uid] = obj
+            self._store(get_uid(obj), obj)
         elif event_type == WatchEventType.DELETED:
-            del self.db[obj.metadata.uid]
+            self._delete(get_uid(obj))
+        elif event_type == WatchEventType.BOOKMARK:
+            # only resource_version is meaningful in bookmark object
+            pass
         elif event_type == WatchEventType.ERROR:
             raise Exception(obj)
         else:
@@ -100,36 +332,282 @@ class KubeWatcher:
 
     def handle_initial(self, obj_list):
         for obj in self._depaginate(obj_list):
-            self.db[obj.metadata.uid] = obj
-            yield WatchEventType.ADDED, obj
+            yield self.handle_initial_object(obj)
 
     def handle_restart(self, obj_list):
         alive_uids = set()
 
         for obj in self._depaginate(obj_list):
-            alive_uids.add(obj.metadata.uid)
-            db_obj = self.db.get(obj.metadata.uid)
-            self.db[obj.metadata.uid] = obj
-            if db_obj is None:
-                yield WatchEventType.ADDED, obj
-            elif db_obj.metadata.resource_version != obj.metadata.resource_version:
-                yield WatchEventType.MODIFIED, obj
-
-        for uid in self.db.keys():
+            event = self.handle_restart_object(obj, alive_uids)
+            if event is not None:
+                yield event
+
+        yield from self.handle_restart_deleted(alive_uids)
+
+    # Per-object steps of initial listing and relisting, shared with `AsyncKubeWatcher`,
+    # override them to change behaviour of both sync and async watchers.
+
+    def handle_initial_object(self, obj):
+        self._store(get_uid(obj), obj)
+        return WatchEventType.ADDED, obj
+
+    def handle_restart_object(self, obj, alive_uids):
+        """
+        Stores listed object, returns event of its change since it was stored or None.
+        """
+        uid = get_uid(obj)
+        alive_uids.add(uid)
+        stored_version = self._get_stored_resource_version(uid) if uid in self.db else None
+        self._store(uid, obj)
+        if stored_version is None:
+            return WatchEventType.ADDED, obj
+        elif stored_version != get_resource_version(obj):
+            return WatchEventType.MODIFIED, obj
+        return None
+
+    def handle_restart_deleted(self, alive_uids):
+        for uid in list(self.db.keys()):
             if uid not in alive_uids:
-                obj = self.db[uid]
-                del self.db[uid]
+                obj = self._delete(uid)
                 yield WatchEventType.DELETED, obj
 
+    def _get_list_kwargs(self, continue_token=None):
+        kwargs = {}
+        if self.namespace is not None:
+            kwargs['namespace'] = self.namespace
+        if self.page_size:
+            kwargs['limit'] = self.page_size
+        if continue_token:
+            kwargs['_continue'] = continue_token
+        return kwargs
+
+    def _list_page(self, continue_token=None):
+        kwargs = self._get_list_kwargs(continue_token)
+        if self.raw:
+            response = self.list_func(_preload_content=False, **kwargs)
+            return json.loads(response.data)
+        return self.list_func(**kwargs)
+
     def _depaginate(self, obj_list):
-        # TODO: handle pages
+        """
+        Yields objects of the first page and requests next pages on the go,
+        so only one page is kept in memory. Stores resourceVersion of the last page.
+        """
+        while True:
+            items, continue_token = self._read_page(obj_list)
+            yield from items
+            if not continue_token:
+                break
 
-        kind = obj_list.kind.removesuffix('List')
-        for obj in obj_list.items:
-            obj.api_version = obj_list.api_version
-            obj.kind = kind
-        return obj_list.items
+            log.debug('Requesting next page')
+            try:
+                obj_list = self._list_page(continue_token)
+            except kubernetes.client.ApiException as e:
+                if e.status == 410:
+                    log.debug('List continue token has expired. Restarting the list')
+                    raise RestartWatchException() from e
+                raise
+
+    def _read_page(self, obj_list):
+        """
+        Returns items of list page and continue token, stores resourceVersion of the page.
+        """
+        if self.raw:
+            kind = obj_list['kind'].removesuffix('List')
+            for obj in obj_list['items']:
+                obj['apiVersion'] = obj_list['apiVersion']
+                obj['kind'] = kind
+            self._list_resource_version = obj_list['metadata']['resourceVersion']
+            return obj_list['items'], obj_list['metadata'].get('continue')
+        else:
+            kind = obj_list.kind.removesuffix('List')
+            for obj in obj_list.items:
+                obj.api_version = obj_list.api_version
+                obj.kind = kind
+            self._list_resource_version = obj_list.metadata.resource_version
+            return obj_list.items, obj_list.metadata._continue
 
 
 class RestartWatchException(Exception):
     pass
+
+
+class RawWatch(kubernetes.watch.Watch):
+    """
+    Watch that yields event objects as dicts parsed from JSON (no OpenAPI model deserialization).
+    """
+
+    def get_return_type(self, func):
+        return None
+
+
+class Indexer:
+    """
+    Secondary indexes of objects by uid, maintained incrementally.
+    """
+
+    def __init__(self, index_funcs):
+        self.index_funcs = dict(index_funcs)
+        self.indexes = {name: collections.defaultdict(set) for name in self.index_funcs}
+        self.values = {name: {} for name in self.index_funcs}  # index name => uid => index values
+
+    def update(self, uid, obj):
+        for name, func in self.index_funcs.items():
+            values = frozenset(func(obj))
+            old_values = self.values[name].get(uid, frozenset())
+            if values == old_values:
+                continue
+            index = self.indexes[name]
+            for value in old_values - values:
+                self._discard(index, value, uid)
+            for value in values - old_values:
+                index[value].add(uid)
+            self.values[name][uid] = values
+
+    def remove(self, uid):
+        for name in self.index_funcs:
+            index = self.indexes[name]
+            for value in self.values[name].pop(uid, ()):
+                self._discard(index, value, uid)
+
+    def restore(self, values):
+        self.values = values
+        self.indexes = {name: collections.defaultdict(set) for name in self.index_funcs}
+        for name, uid_values in values.items():
+            index = self.indexes[name]
+            for uid, index_values in uid_values.items():
+                for value in index_values:
+                    index[value].add(uid)
+
+    @staticmethod
+    def _discard(index, value, uid):
+        uids = index[value]
+        uids.discard(uid)
+        if not uids:
+            del index[value]
+
+    def get_uids(self, index_name, value):
+        return self.indexes[index_name].get(value, ())
+
+
+def index_by_namespace(obj):
+    namespace = get_metadata_field(obj, 'namespace', 'namespace')
+    return (namespace,) if namespace else ()
+
+
+def index_by_labels(obj):
+    """
+    Index values are `key=value` strings.
+    """
+    labels = get_metadata_field(obj, 'labels', 'labels') or {}
+    return (f'{key}={value}' for key, value in labels.items())
+
+
+def index_by_owner_uid(obj):
+    owner_references = get_metadata_field(obj, 'owner_references', 'ownerReferences') or ()
+    return (ref['uid'] if isinstance(ref, dict) else ref.uid for ref in owner_references)
+
+
+def get_metadata_field(obj, attr_name, key):
+    if isinstance(obj, dict):
+        return obj['metadata'].get(key)
+    return getattr(obj.metadata, attr_name, None)
+
+
+class KubeObjectRecord:
+    """
+    Base class of compact records made by `make_projection()`.
+    """
+    __slots__ = ('uid', 'resource_version')
+    fields = ()
+
+    def __init__(self, uid, resource_version, *values):
+        self.uid = uid
+        self.resource_version = resource_version
+        for field, value in zip(self.fields, values):
+            setattr(self, field, value)
+
+    def __reduce__(self):
+        values = tuple(getattr(self, field) for field in self.fields)
+        return _make_record, (self.fields, self.uid, self.resource_version) + values
+
+    def __repr__(self):
+        values = ', '.join(f'{field}={getattr(self, field)!r}' for field in self.__slots__)
+        return f'{self.__class__.__name__}(uid={self.uid!r}, resource_version={self.resource_version!r}, {values})'
+
+
+def make_projection(paths):
+    """
+    Returns function that makes `KubeObjectRecord` with values of JSON paths (camelCase, dot-separated)
+    from kubernetes model objects or raw dicts. Fields are named in snake_case with dots replaced by `__`,
+    e.g. `spec.nodeName` becomes `spec__node_name`.
+    """
+    paths = [(path.split('.'), [camel_to_snake(part) for part in path.split('.')]) for path in paths]
+    fields = tuple('__'.join(snake_parts) for _, snake_parts in paths)
+    record_class = get_record_class(fields)
+
+    def projection(obj):
+        if isinstance(obj, dict):
+            values = (get_dict_path(obj, parts) for parts, _ in paths)
+        else:
+            values = (get_attr_path(obj, snake_parts) for _, snake_parts in paths)
+        return record_class(get_uid(obj), get_resource_version(obj), *values)
+
+    projection.fields = fields
+    return projection
+
+
+@functools.lru_cache(maxsize=None)
+def get_record_class(fields):
+    return type('KubeObjectRecord', (KubeObjectRecord,), {'__slots__': fields, 'fields': fields})
+
+
+def _make_record(fields, *args):
+    return get_record_class(fields)(*args)
+
+
+def get_dict_path(obj, parts):
+    for part in parts:
+        if obj is None:
+            return None
+        obj = obj.get(part)
+    return obj
+
+
+def get_attr_path(obj, parts):
+    for part in parts:
+        if obj is None:
+            return None
+        obj = getattr(obj, part, None)
+    return obj
+
+
+def camel_to_snake(name):
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', name).lower()
+
+
+def get_uid(obj):
+    if isinstance(obj, dict):
+        return obj['metadata']['uid']
+    if isinstance(obj, KubeObjectRecord):
+        return obj.uid
+    return obj.metadata.uid
+
+
+def get_resource_version(obj):
+    if isinstance(obj, dict):
+        return obj['metadata']['resourceVersion']
+    if isinstance(obj, KubeObjectRecord):
+        return obj.resource_version
+    return obj.metadata.resource_version
+
+
+def get_event_resource_version(event):
+    """
+    Reads version from `raw_object` of watch event: BOOKMARK objects have only `metadata.resourceVersion`
+    and are left as dicts or deserialized to empty models depending on client version.
+    """
+    raw_object = event.get('raw_object')
+    if raw_object is not None:
+        return raw_object['metadata']['resourceVersion']
+    return get_resource_version(event['object'])
@@ -0,0 +1,1197 @@
+import os
+import math
+import time
+import uuid
+import types
+import random
+import heapq
+import logging
+import itertools
+import threading
+import collections
+from contextlib import contextmanager
+
+from utils.lock.backends import get_default_backend, get_key_backend
+
+log = logging.getLogger(__name__)
+DEFAULT_TIMEOUT = 300
+long_lock_ttl = 30
+
+
+@contextmanager
+def get_lock(lockname, timeout=DEFAULT_TIMEOUT, retry_times=1, retry_delay=200, backend=None):
+    from redlock import RedLock
+
+    redis_client = (backend or get_default_backend()).get_client()
+
+    if timeout is None:
+        # redlock doesn't support infinite timeout
+        # anyway it's bad idea to have infinite lock
+        timeout = DEFAULT_TIMEOUT
+
+    lock = RedLock(lockname, [redis_client], retry_times=retry_times, retry_delay=retry_delay, ttl=int(timeout * 1000))
+    got_lock = lock.acquire()
+    try:
+        yield got_lock
+    finally:
+        if got_lock:
+            lock.release()
+
+
+acquire_many_script_src = """
+for _, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        return 0
+    end
+end
+for _, key in ipairs(KEYS) do
+    redis.call('SET', key, ARGV[1], 'PX', ARGV[2])
+end
+return 1
+"""
+
+release_many_script_src = """
+local released = 0
+for _, key in ipairs(KEYS) do
+    if redis.call('GET', key) == ARGV[1] then
+        redis.call('DEL', key)
+        released = released + 1
+    end
+end
+return released
+"""
+
+
+@contextmanager
+def get_locks(locknames, timeout=DEFAULT_TIMEOUT, retry_times=1, retry_delay=200, backend=None):
+    """
+    Acquires all locks at once (all-or-nothing) with one script call, releases them with one script call.
+    Lock keys are the same as of `get_lock`, so these locks exclude each other.
+    Empty set of locks is always acquired.
+    """
+    locknames = sorted(set(locknames))
+    if not locknames:
+        yield True
+        return
+
+    redis_client = (backend or get_default_backend()).get_client()
+
+    if timeout is None:
+        timeout = DEFAULT_TIMEOUT
+
+    token = uuid.uuid4().hex
+    ttl = int(timeout * 1000)
+    acquire_script = redis_client.register_script(acquire_many_script_src)
+    release_script = redis_client.register_script(release_many_script_src)
+
+    got_lock = False
+    for retry in range(retry_times):
+        if retry > 0:
+            time.sleep(random.randint(0, retry_delay) / 1000)
+        got_lock = acquire_script(keys=locknames, args=[token, ttl]) == 1
+        if got_lock:
+            break
+
+    try:
+        yield got_lock
+    finally:
+        if got_lock:
+            release_script(keys=locknames, args=[token])
+
+
+def get_locks_function(name_prefix, default_timeout=None, name_separator=':'):
+    """
+    Like `get_lock_function`, but accepts iterable of name parts tuples (or single values).
+    """
+    @contextmanager
+    def func(names, **kwargs):
+        timeout = kwargs.get('timeout', default_timeout)
+        locknames = [make_lockname(name_prefix, name if isinstance(name, tuple) else (name,), name_separator)
+                     for name in names]
+        with get_locks(locknames, timeout=timeout) as lock:
+            yield lock
+    return func
+
+
+@contextmanager
+def get_long_lock(lockname, retry_times=1, retry_delay=200, on_lost=None, backend=None):
+    """
+    Lock that is held until context exits, its TTL is extended in background by `LongLockRenewer`.
+    Yields `LongLockHandle`, which is falsy if lock wasn't acquired (it used to yield bool:
+    check it by truthiness, `handle is True` is never true).
+    If the lock is lost (e.g. expired because of network failure), `handle.lost` event is set
+    and `on_lost(lockname)` is called from renewer thread, the holder should abort its work.
+    """
+    from redlock import RedLock
+
+    redis_client = (backend or get_default_backend()).get_client()
+
+    ttl = int(long_lock_ttl * 1000)
+    lock = RedLock(lockname, [redis_client], retry_times=retry_times, retry_delay=retry_delay, ttl=ttl)
+    got_lock = lock.acquire()
+    handle = LongLockHandle(lock, got_lock, on_lost)
+
+    if got_lock:
+        LongLockRenewer.get_instance().add(handle)
+
+    try:
+        yield handle
+    finally:
+        if got_lock:
+            LongLockRenewer.get_instance().remove(handle)
+            lock.release()
+
+
+class LongLockHandle:
+    def __init__(self, lock, acquired, on_lost=None):
+        self.lock = lock
+        self.acquired = acquired
+        self.on_lost = on_lost
+        self.lost = threading.Event()
+        self.expires_at = time.monotonic() + lock.ttl / 1000
+        self.cancelled = False
+
+    def __bool__(self):
+        return self.acquired and not self.lost.is_set()
+
+    @property
+    def is_lost(self):
+        return self.lost.is_set()
+
+    def mark_lost(self):
+        log.warning('Long lock %s is lost', self.lock.resource)
+        self.lost.set()
+        if self.on_lost:
+            try:
+                self.on_lost(self.lock.resource)
+            except Exception:
+                log.exception('Failed to notify about lost lock %s', self.lock.resource)
+
+
+extend_script_src = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class LongLockRenewer:
+    """
+    Process-wide thread which extends TTL of all held long locks.
+    Locks are renewed at half of TTL, locks due within `coalesce_window` seconds are renewed together
+    with one pipelined round-trip per Redis node. Renewal is compare-and-extend, so lost lock is never resurrected.
+    """
+
+    coalesce_window = 1
+    retry_delay = 1
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    @classmethod
+    def _reset_after_fork(cls):
+        # locks of parent are not held by child, and the lock may have been held by another thread while forking
+        cls._instance = None
+        cls._instance_lock = threading.Lock()
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._thread_for_pid = None
+        self._script_shas = {}
+
+    def _ensure_thread(self):
+        if self._thread_for_pid == os.getpid() and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name='LongLockRenewer', daemon=True)
+        self._thread.start()
+        self._thread_for_pid = os.getpid()
+
+    def add(self, handle):
+        with self._cond:
+            self._ensure_thread()
+            self._schedule(handle, time.monotonic() + handle.lock.ttl * 0.5 / 1000)
+            self._cond.notify()
+
+    def remove(self, handle):
+        with self._cond:
+            # lazy removal from heap
+            handle.cancelled = True
+
+    def _schedule(self, handle, deadline):
+        heapq.heappush(self._heap, (deadline, next(self._counter), handle))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._cond.wait(timeout)
+
+                due = []
+                horizon = time.monotonic() + self.coalesce_window
+                while self._heap and self._heap[0][0] <= horizon:
+                    handle = heapq.heappop(self._heap)[2]
+                    if not handle.cancelled:
+                        due.append(handle)
+
+            if due:
+                self._renew(due)
+
+    def _renew(self, handles):
+        handles_by_node = collections.defaultdict(list)
+        for handle in handles:
+            for node in handle.lock.redis_nodes:
+                handles_by_node[node].append(handle)
+
+        renewed = set()
+        failed = set()
+        lost = set()
+        for node, node_handles in handles_by_node.items():
+            try:
+                results = self._extend(node, node_handles)
+            except Exception:
+                log.exception('Failed to renew long locks')
+                failed.update(node_handles)
+                continue
+            for handle, result in zip(node_handles, results):
+                if result == 1:
+                    renewed.add(handle)
+                else:
+                    lost.add(handle)
+
+        now = time.monotonic()
+        with self._cond:
+            for handle in handles:
+                # released concurrently with renewal: key is already deleted by its holder
+                if handle.cancelled or handle.is_lost:
+                    continue
+                if handle in lost:
+                    handle.mark_lost()
+                    continue
+                if handle in failed:
+                    if now >= handle.expires_at:
+                        handle.mark_lost()
+                    else:
+                        self._schedule(handle, now + self.retry_delay)
+                elif handle in renewed:
+                    handle.expires_at = now + handle.lock.ttl / 1000
+                    self._schedule(handle, now + handle.lock.ttl * 0.5 / 1000)
+
+    def _extend(self, node, handles):
+        from redis.exceptions import NoScriptError
+
+        sha = self._script_shas.get(node)
+        if sha is None:
+            sha = self._script_shas[node] = node.script_load(extend_script_src)
+
+        def execute():
+            pipe = node.pipeline(transaction=False)
+            for handle in handles:
+                pipe.evalsha(sha, 1, handle.lock.resource, handle.lock.lock_key, handle.lock.ttl)
+            return pipe.execute(raise_on_error=False)
+
+        results = execute()
+        if any(isinstance(result, NoScriptError) for result in results):
+            node.script_load(extend_script_src)
+            results = execute()
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=LongLockRenewer._reset_after_fork)
+
+
+def get_lock_function(name_prefix, default_timeout=None, name_separator=':'):
+    @contextmanager
+    def func(*name_parts, **kwargs):
+        timeout = kwargs.get('timeout', default_timeout)
+        lockname = make_lockname(name_prefix, name_parts, name_separator)
+        with get_lock(lockname, timeout=timeout) as lock:
+            yield lock
+    return func
+
+
+def get_long_lock_function(name_prefix, name_separator=':'):
+    @contextmanager
+    def func(*name_parts, **kwargs):
+        lockname = make_lockname(name_prefix, name_parts, name_separator)
+        with get_long_lock(lockname) as lock:
+            yield lock
+    return func
+
+
+def make_lockname(name_prefix, name_parts, name_separator=':'):
+    name_parts = itertools.chain((name_prefix,), name_parts)
+    return name_separator.join(str(part) for part in name_parts)
+
+
+class DistributedRateLimiter:
+    """
+    Allows you to run some code at specified rate.
+    Usable only for high rates (> 1 Hz), because it blocks current thread.
+    Requires Redis at least 2.6 (with Lua).
+
+    If `lease_size` is set, time slots are reserved from Redis in batches of `lease_size` with one script call
+    and handed out locally, so Redis is hit once per `lease_size` calls instead of twice per call.
+    Requires Redis at least 3.2 in this mode (script effects replication, default since Redis 5).
+    Unused slots of key not waited for `lease_idle_timeout` seconds are given back by background thread
+    (or by `release()`), if nobody has reserved slots after them yet.
+    """
+
+    _script_map = {}
+    _script_src = """
+    local current_time = tonumber(ARGV[1])
+    local min_delay = tonumber(ARGV[2])
+
+    local wait, next_call_time
+
+    local last_call_time = redis.call('GET', KEYS[1])
+    if last_call_time then
+        last_call_time = tonumber(last_call_time)
+        next_call_time = last_call_time + min_delay
+        if next_call_time > current_time then
+            wait = next_call_time - current_time
+        else
+            wait = 0
+            next_call_time = current_time
+        end
+    else
+        wait = 0
+        next_call_time = current_time
+    end
+
+    redis.call('SET', KEYS[1], next_call_time)
+    redis.call('EXPIRE', KEYS[1], math.ceil(wait + min_delay))
+    return tostring(wait)
+    """
+
+    _lease_script_map = {}
+    _lease_script_src = """
+    if redis.replicate_commands then
+        redis.replicate_commands()
+    end
+    local t = redis.call('TIME')
+    local current_time = tonumber(t[1]) + tonumber(t[2]) / 1000000
+    local min_delay = tonumber(ARGV[1])
+    local count = tonumber(ARGV[2])
+
+    local first_call_time = current_time
+    local last_call_time = redis.call('GET', KEYS[1])
+    if last_call_time then
+        last_call_time = tonumber(last_call_time) + min_delay
+        if last_call_time > current_time then
+            first_call_time = last_call_time
+        end
+    end
+
+    local lease_end = tostring(first_call_time + (count - 1) * min_delay)
+    local ttl = math.ceil((tonumber(lease_end) - current_time + min_delay) * 1000)
+    redis.call('SET', KEYS[1], lease_end, 'PX', ttl)
+    return {tostring(current_time), tostring(first_call_time), lease_end}
+    """
+
+    _return_script_map = {}
+    _return_script_src = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        local ttl = redis.call('PTTL', KEYS[1])
+        if ttl > 0 then
+            redis.call('SET', KEYS[1], ARGV[2], 'PX', ttl)
+        else
+            redis.call('SET', KEYS[1], ARGV[2])
+        end
+        return 1
+    end
+    return 0
+    """
+
+    def __init__(self, max_rate_hz, name='', redis_client=None, lease_size=None, backend=None, lease_idle_timeout=1):
+        if redis_client is None:
+            redis_client = (backend or get_default_backend()).get_client()
+        self._client = redis_client
+        self._script = self._get_script(self._script_map, self._script_src)
+        self._max_rate = self._min_delay = 0
+        self.max_rate_hz = max_rate_hz  # invoke setter
+        self.name = name
+        self.lease_size = lease_size
+        self.lease_idle_timeout = lease_idle_timeout
+        self._leases = {}
+        self._leases_lock = threading.Lock()
+        self._lease_returner = None
+        self._lease_returner_for_pid = None
+        if lease_size:
+            self._lease_script = self._get_script(self._lease_script_map, self._lease_script_src)
+            self._return_script = self._get_script(self._return_script_map, self._return_script_src)
+
+    def _get_script(self, script_map, script_src):
+        try:
+            return script_map[self._client]
+        except KeyError:
+            script = script_map[self._client] = self._client.register_script(script_src)
+            return script
+
+    @property
+    def max_rate_hz(self):
+        return self._max_rate
+
+    @max_rate_hz.setter
+    def max_rate_hz(self, value):
+        self._max_rate = value
+        self._min_delay = 1.0 / float(value)
+
+    def _get_redis_key(self, key):
+        if key:
+            return f'last:{self.name}:{key}'
+        else:
+            return f'last:{self.name}'
+
+    def wait(self, key=None):
+        if self.lease_size:
+            return self._wait_leased(key)
+
+        redis_key = self._get_redis_key(key)
+        if key:
+            log.debug('Requesting %s time frame for key %s...', self.name, key)
+        else:
+            log.debug('Requesting %s time frame...', self.name)
+
+        redis_time = float('%d.%06d' % self._client.time())
+        log.debug('Redis time: %s', redis_time)
+
+        delay = float(self._script(keys=[redis_key], args=[redis_time, self._min_delay]))
+        self._sleep(delay, key)
+
+    def _wait_leased(self, key):
+        redis_key = self._get_redis_key(key)
+
+        with self._leases_lock:
+            lease = self._leases.get(redis_key)
+            # exhausted lease has no slots to return
+            if lease is None or not lease.take_slot():
+                if key:
+                    log.debug('Leasing %d %s time frames for key %s...', self.lease_size, self.name, key)
+                else:
+                    log.debug('Leasing %d %s time frames...', self.lease_size, self.name)
+                lease = self._leases[redis_key] = self._take_lease(redis_key)
+                lease.take_slot()
+                self._ensure_lease_returner()
+            delay = lease.slot_delay
+
+        self._sleep(delay, key)
+
+    def _take_lease(self, redis_key):
+        redis_time, first_slot_time, lease_end = self._lease_script(
+            keys=[redis_key], args=[self._min_delay, self.lease_size])
+        return RateLimiterLease(float(redis_time), float(first_slot_time), self.lease_size, self._min_delay,
+                                lease_end)
+
+    def _return_lease(self, redis_key, lease):
+        if not lease.unused_slots:
+            return
+        returned = self._return_script(keys=[redis_key], args=[lease.lease_end, lease.last_used_slot_time])
+        if returned:
+            log.debug('Returned %d unused %s time frames', lease.unused_slots, self.name)
+        else:
+            log.debug('Unused %s time frames were not returned, they are followed by another lease', self.name)
+
+    def _ensure_lease_returner(self):
+        # called under leases lock
+        if self._lease_returner is not None and self._lease_returner_for_pid == os.getpid():
+            return
+        self._lease_returner = threading.Thread(
+            target=self._return_idle_leases, name='DistributedRateLimiter_LeaseReturner', daemon=True)
+        self._lease_returner.start()
+        self._lease_returner_for_pid = os.getpid()
+
+    def _return_idle_leases(self):
+        while True:
+            time.sleep(self.lease_idle_timeout)
+            with self._leases_lock:
+                idle_since = time.monotonic() - self.lease_idle_timeout
+                for redis_key, lease in list(self._leases.items()):
+                    if lease.slot_taken_at <= idle_since:
+                        del self._leases[redis_key]
+                        lease.expire()
+                        try:
+                            self._return_lease(redis_key, lease)
+                        except Exception:
+                            log.exception('Failed to return unused %s time frames', self.name)
+                if not self._leases:
+                    # started again with next lease
+                    self._lease_returner = None
+                    return
+
+    def release(self):
+        """
+        Give back unused leased time frames of all keys.
+        """
+        with self._leases_lock:
+            leases, self._leases = self._leases, {}
+            for redis_key, lease in leases.items():
+                lease.expire()
+                self._return_lease(redis_key, lease)
+
+    def _sleep(self, delay, key):
+        if delay > 0:
+            if key:
+                log.debug('%s rate limit hit for key %s! Sleeping for %s seconds', self.name, key, delay)
+            else:
+                log.debug('%s rate limit hit! Sleeping for %s seconds', self.name, delay)
+            time.sleep(delay)
+        else:
+            log.debug('Continue without delay')
+
+
+class RateLimiterLease:
+    """
+    Batch of consecutive time slots reserved by `DistributedRateLimiter` in Redis time.
+    The lease expires when its next slot is already in the past (handing it out would allow a burst).
+    """
+
+    def __init__(self, redis_time, first_slot_time, size, min_delay, lease_end):
+        # offset between Redis clock and local clock, network latency is neglected
+        self.clock_offset = redis_time - time.time()
+        self.first_slot_time = first_slot_time
+        self.size = size
+        self.min_delay = min_delay
+        self.lease_end = lease_end
+        self.used_slots = 0
+        self.slot_delay = 0
+        self.slot_taken_at = time.monotonic()
+
+    @property
+    def unused_slots(self):
+        return self.size - self.used_slots
+
+    @property
+    def last_used_slot_time(self):
+        return repr(self.first_slot_time + (self.used_slots - 1) * self.min_delay)
+
+    def now(self):
+        return time.time() + self.clock_offset
+
+    def expire(self):
+        now = self.now()
+        while self.unused_slots and self.first_slot_time + self.used_slots * self.min_delay < now - self.min_delay:
+            self.used_slots += 1
+
+    def take_slot(self):
+        self.expire()
+        if not self.unused_slots:
+            return False
+        slot_time = self.first_slot_time + self.used_slots * self.min_delay
+        self.used_slots += 1
+        self.slot_delay = slot_time - self.now()
+        self.slot_taken_at = time.monotonic()
+        return True
+
+
+class LockingRateLimiter:
+    def __init__(self, max_rate_hz, name):
+        self.max_rate_hz = max_rate_hz
+        self.name = name
+
+    @contextmanager
+    def get_time_frame(self, key=None):
+        raise NotImplementedError
+
+
+class FakeLockingRateLimiter(LockingRateLimiter):
+    @contextmanager
+    def get_time_frame(self, key=None):
+        yield
+
+
+class LocalRateLimiter(LockingRateLimiter):
+    """
+    Process-local rate limiter with the same API as `DistributedRateLimiter` (thread-safe, no Redis).
+    Every key has its own token bucket of `burst` size, idle buckets are evicted when there are more
+    than `max_keys` of them (least recently used first).
+
+    In hybrid mode (`hybrid_local_fraction` is set) local bucket allows `max_rate_hz * hybrid_local_fraction`
+    calls per second without Redis and the rest of calls go to `DistributedRateLimiter` limited by the remaining
+    part of the rate. Local fraction is per process, split it between replicas yourself.
+    """
+
+    def __init__(self, max_rate_hz, name='', burst=1, max_keys=10000, hybrid_local_fraction=None,
+                 redis_client=None, backend=None):
+        if hybrid_local_fraction is not None and not 0 < hybrid_local_fraction < 1:
+            raise ValueError('hybrid_local_fraction must be between 0 and 1 (exclusive)')
+        self._max_rate = self._min_delay = 0
+        self.hybrid_local_fraction = hybrid_local_fraction
+        self._remote = None
+        if hybrid_local_fraction is not None:
+            self._remote = DistributedRateLimiter(max_rate_hz * (1 - hybrid_local_fraction), name,
+                                                  redis_client=redis_client, backend=backend)
+        super().__init__(max_rate_hz, name)
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = collections.OrderedDict()  # key => theoretical arrival time of next call
+        self._lock = threading.Lock()
+
+    @property
+    def max_rate_hz(self):
+        return self._max_rate
+
+    @max_rate_hz.setter
+    def max_rate_hz(self, value):
+        self._max_rate = value
+        if self._remote is not None:
+            self._remote.max_rate_hz = value * (1 - self.hybrid_local_fraction)
+            value *= self.hybrid_local_fraction
+        self._min_delay = 1.0 / float(value)
+
+    def _reserve(self, key, wait_allowed):
+        """
+        Generic cell rate algorithm, returns delay before call or None if delay is not allowed.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tat = max(self._buckets.pop(key, now), now)
+            delay = tat - (self.burst - 1) * self._min_delay - now
+            if delay > 0 and not wait_allowed:
+                self._buckets[key] = tat
+                return None
+            self._buckets[key] = tat + self._min_delay
+
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return max(delay, 0)
+
+    def wait(self, key=None):
+        delay = self._reserve(key, wait_allowed=self._remote is None)
+        if delay is None:
+            log.debug('%s local rate exceeded, falling back to distributed limiter', self.name)
+            return self._remote.wait(key)
+
+        if delay > 0:
+            log.debug('%s rate limit hit! Sleeping for %s seconds', self.name, delay)
+            time.sleep(delay)
+
+    @contextmanager
+    def get_time_frame(self, key=None):
+        self.wait(key)
+        yield
+
+
+class LocalLockingRateLimiter(LockingRateLimiter):
+    """
+    Process-local version of `DistributedLockingRateLimiter` (thread-safe, no Redis).
+    Next time frame of key starts `1 / max_rate_hz` seconds after previous one is finished.
+    Idle keys are evicted when there are more than `max_keys` of them (least recently used first).
+    """
+
+    def __init__(self, max_rate_hz, name='', timeout=60, max_keys=10000):
+        self._max_rate = self._min_delay = 0
+        super().__init__(max_rate_hz, name)
+        self.timeout = timeout
+        self.max_keys = max_keys
+        self._frames = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def max_rate_hz(self):
+        return self._max_rate
+
+    @max_rate_hz.setter
+    def max_rate_hz(self, value):
+        self._max_rate = value
+        self._min_delay = 1.0 / float(value)
+
+    def _get_frame(self, key):
+        with self._lock:
+            try:
+                frame = self._frames[key]
+                self._frames.move_to_end(key)
+            except KeyError:
+                frame = self._frames[key] = LocalTimeFrame()
+            frame.users += 1
+
+            if len(self._frames) > self.max_keys:
+                for idle_key in [k for k, f in self._frames.items() if not f.users]:
+                    del self._frames[idle_key]
+                    if len(self._frames) <= self.max_keys:
+                        break
+            return frame
+
+    def _put_frame(self, frame):
+        with self._lock:
+            frame.users -= 1
+
+    @contextmanager
+    def get_time_frame(self, key=None):
+        frame = self._get_frame(key)
+        try:
+            got_lock = frame.lock.acquire(timeout=-1 if self.timeout is None else self.timeout)
+            if not got_lock:
+                log.debug('Timeout hit')
+
+            delay = frame.ready_time - time.monotonic()
+            if delay > 0:
+                log.debug('Rate limit hit! Sleeping for %s seconds', delay)
+                time.sleep(delay)
+
+            try:
+                yield
+            finally:
+                if got_lock:
+                    frame.ready_time = time.monotonic() + self._min_delay
+                    frame.lock.release()
+        finally:
+            self._put_frame(frame)
+
+
+class LocalTimeFrame:
+    __slots__ = ('lock', 'ready_time', 'users')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ready_time = 0
+        self.users = 0
+
+
+class DistributedLockingRateLimiter(LockingRateLimiter):
+    """
+    Allows you to run some code at specified rate and locking during operation.
+    Usable only for high rates (> 1 Hz), because it blocks current thread.
+    Requires Redis at least 2.6 (with Lua).
+    """
+
+    def __init__(self, max_rate_hz, name, timeout=60, redis_client=None, backend=None):
+        self._max_rate = self._min_delay = 0
+        super().__init__(max_rate_hz, name)
+        self.timeout = timeout
+
+        if backend is None:
+            # explicit client still gets keys of default backend, so they match processes not passing it
+            backend = get_key_backend() if redis_client is not None else get_default_backend()
+        self._backend = backend
+        if redis_client is None:
+            redis_client = backend.get_client()
+        self._client = redis_client
+
+    @property
+    def max_rate_hz(self):
+        return self._max_rate
+
+    @max_rate_hz.setter
+    def max_rate_hz(self, value):
+        self._max_rate = value
+        self._min_delay = 1.0 / float(value)
+
+    def _get_lock_key(self, key):
+        if key:
+            lock_key = f'lock:{self.name}:{key}'
+        else:
+            lock_key = f'lock:{self.name}'
+        return self._backend.make_key(lock_key)
+
+    @contextmanager
+    def get_time_frame(self, key=None):
+        lock_key = self._get_lock_key(key)
+        log.debug('Requesting %s time frame...', lock_key)
+
+        exists_key = lock_key + ':exists'
+        exists = self._client.getset(exists_key, 1)
+        if self.timeout is not None:
+            self._client.expire(exists_key, self.timeout)
+
+        if exists is None:
+            log.debug('Lock does not exist, initialize it')
+            self._client.rpush(lock_key, 0)
+        else:
+            log.debug('Lock already exists, waiting for it')
+
+        blpop_result = self._client.blpop(lock_key, self.timeout)
+        if blpop_result is not None:
+            ready_time = float(blpop_result[1])
+        else:
+            log.debug('Timeout hit')
+            ready_time = 0
+
+        if ready_time:
+            log.debug('Next free time frame will be at %s', ready_time)
+        else:
+            log.debug('Next free time frame is NOW')
+
+        redis_time = self.get_current_redis_time()
+        log.debug('Current redis time: %s', redis_time)
+
+        delay = ready_time - redis_time
+        if delay > 0:
+            log.debug('Rate limit hit! Sleeping for %s seconds', delay)
+            time.sleep(delay)
+        else:
+            log.debug('Continue without delay')
+
+        log.debug('Running job in time frame %s...', lock_key)
+        try:
+            yield
+        finally:
+            log.debug('Job finished in time frame %s', lock_key)
+
+            redis_time = self.get_current_redis_time()
+            log.debug('Current redis time: %s', redis_time)
+
+            ready_time = redis_time + self._min_delay
+            log.debug('Next free time frame will be at %s', ready_time)
+
+            self._client.set(exists_key, 1, ex=self.timeout)
+            self._client.rpush(lock_key, str(ready_time))
+            if self.timeout is not None:
+                self._client.expire(lock_key, self.timeout)
+
+    def get_current_redis_time(self):
+        return float('%d.%06d' % self._client.time())
+
+
+class FairDistributedLockingRateLimiter(DistributedLockingRateLimiter):
+    """
+    `DistributedLockingRateLimiter` with FIFO ordering of waiters and holder heartbeats.
+    Acquire and release are single Lua script calls (requires Redis at least 3.2).
+    Waiters block on personal wake list, holder wakes the next waiter on release.
+    Heartbeat of holder is extended by `LongLockRenewer`, if holder dies its time frame is reclaimed
+    within `heartbeat_ttl` seconds instead of `timeout`.
+    Waiters refresh their heartbeats every `heartbeat_ttl / 2` seconds, `heartbeat_ttl` below 2 seconds
+    requires Redis at least 6.0 (fractional BLPOP timeout).
+    """
+
+    _acquire_script_map = {}
+    _acquire_script_src = """
+    if redis.replicate_commands then
+        redis.replicate_commands()
+    end
+    local t = redis.call('TIME')
+    -- microseconds, formatted explicitly: numbers are converted to strings with 14 significant digits
+    local now = tonumber(t[1]) * 1000000 + tonumber(t[2])
+    local now_str = string.format('%.0f', now)
+    local token = ARGV[1]
+    local heartbeat_ttl = tonumber(ARGV[2])
+    local keys_ttl = tonumber(ARGV[3])
+
+    -- forget dead waiters
+    local dead = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', now_str)
+    for _, member in ipairs(dead) do
+        redis.call('ZREM', KEYS[2], member)
+    end
+    redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now_str)
+
+    redis.call('ZADD', KEYS[3], string.format('%.0f', now + heartbeat_ttl * 1000), token)
+    if not redis.call('ZSCORE', KEYS[2], token) then
+        redis.call('ZADD', KEYS[2], redis.call('INCR', KEYS[5]), token)
+    end
+    redis.call('EXPIRE', KEYS[2], keys_ttl)
+    redis.call('EXPIRE', KEYS[3], keys_ttl)
+    redis.call('EXPIRE', KEYS[5], keys_ttl)
+
+    if redis.call('GET', KEYS[1]) or redis.call('ZRANGE', KEYS[2], 0, 0)[1] ~= token then
+        return {0, 0}
+    end
+
+    redis.call('ZREM', KEYS[2], token)
+    redis.call('ZREM', KEYS[3], token)
+    redis.call('DEL', KEYS[6])
+    redis.call('SET', KEYS[1], token, 'PX', heartbeat_ttl)
+    local ready_time = tonumber(redis.call('GET', KEYS[4]) or 0)
+    return {1, math.max(0, ready_time - now)}
+    """
+
+    _release_script_map = {}
+    _release_script_src = """
+    if redis.replicate_commands then
+        redis.replicate_commands()
+    end
+    if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+        return 0
+    end
+    local t = redis.call('TIME')
+    local now = tonumber(t[1]) * 1000000 + tonumber(t[2])
+    local keys_ttl = tonumber(ARGV[3])
+
+    redis.call('DEL', KEYS[1])
+    redis.call('SET', KEYS[4], string.format('%.0f', now + tonumber(ARGV[2])), 'EX', keys_ttl)
+
+    local next_token = redis.call('ZRANGE', KEYS[2], 0, 0)[1]
+    if next_token then
+        local wake_key = ARGV[4] .. next_token
+        redis.call('RPUSH', wake_key, 1)
+        redis.call('EXPIRE', wake_key, keys_ttl)
+    end
+    return 1
+    """
+
+    _leave_script_map = {}
+    _leave_script_src = """
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    redis.call('ZREM', KEYS[3], ARGV[1])
+    redis.call('DEL', ARGV[2] .. ARGV[1])
+    -- this waiter may have been woken up already, pass the wake-up to the next one
+    if not redis.call('GET', KEYS[1]) then
+        local next_token = redis.call('ZRANGE', KEYS[2], 0, 0)[1]
+        if next_token then
+            local wake_key = ARGV[2] .. next_token
+            redis.call('RPUSH', wake_key, 1)
+            redis.call('EXPIRE', wake_key, ARGV[3])
+        end
+    end
+    return 1
+    """
+
+    _get_script = DistributedRateLimiter._get_script
+
+    def __init__(self, max_rate_hz, name, timeout=60, redis_client=None, heartbeat_ttl=5, backend=None):
+        super().__init__(max_rate_hz, name, timeout=timeout, redis_client=redis_client, backend=backend)
+        self.heartbeat_ttl = heartbeat_ttl
+        self._acquire_script = self._get_script(self._acquire_script_map, self._acquire_script_src)
+        self._release_script = self._get_script(self._release_script_map, self._release_script_src)
+        self._leave_script = self._get_script(self._leave_script_map, self._leave_script_src)
+
+    def _start_heartbeat(self, holder_key, token):
+        frame = types.SimpleNamespace(resource=holder_key, lock_key=token, ttl=int(self.heartbeat_ttl * 1000),
+                                      redis_nodes=[self._client])
+        handle = LongLockHandle(frame, True)
+        LongLockRenewer.get_instance().add(handle)
+        return handle
+
+    @property
+    def _keys_ttl(self):
+        return max(self.timeout or DEFAULT_TIMEOUT, self.heartbeat_ttl)
+
+    @contextmanager
+    def get_time_frame(self, key=None):
+        lock_key = self._get_lock_key(key)
+        token = uuid.uuid4().hex
+        holder_key = lock_key + ':holder'
+        queue_key = lock_key + ':queue'
+        heartbeat_key = lock_key + ':heartbeat'
+        ready_time_key = lock_key + ':ready'
+        wake_key_prefix = lock_key + ':wake:'
+        wake_key = wake_key_prefix + token
+        acquire_keys = [holder_key, queue_key, heartbeat_key, ready_time_key, lock_key + ':seq', wake_key]
+        heartbeat_ttl_ms = int(self.heartbeat_ttl * 1000)
+        log.debug('Requesting %s time frame...', lock_key)
+
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            acquired, delay_us = self._acquire_script(keys=acquire_keys,
+                                                      args=[token, heartbeat_ttl_ms, self._keys_ttl])
+            if acquired:
+                break
+
+            wait = self.heartbeat_ttl / 2
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    log.debug('Timeout hit')
+                    self._leave_script(keys=acquire_keys[:3], args=[token, wake_key_prefix, self._keys_ttl])
+                    delay_us = 0
+                    break
+            # waiting for holder release or heartbeat, must return before heartbeat of this waiter expires
+            self._client.blpop(wake_key, math.floor(wait) if wait >= 1 else wait)
+
+        handle = None
+        if acquired:
+            handle = self._start_heartbeat(holder_key, token)
+
+        delay = delay_us / 1000000
+        if delay > 0:
+            log.debug('Rate limit hit! Sleeping for %s seconds', delay)
+            time.sleep(delay)
+        else:
+            log.debug('Continue without delay')
+
+        log.debug('Running job in time frame %s...', lock_key)
+        try:
+            yield
+        finally:
+            log.debug('Job finished in time frame %s', lock_key)
+            if handle is not None:
+                LongLockRenewer.get_instance().remove(handle)
+                self._release_script(keys=[holder_key, queue_key, heartbeat_key, ready_time_key],
+                                     args=[token, round(self._min_delay * 1000000), self._keys_ttl, wake_key_prefix])
+
+
+_acquire_frames_script_map = {}
+_acquire_frames_script_src = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000000 + tonumber(t[2])
+local now_str = string.format('%.0f', now)
+local token = ARGV[1]
+local heartbeat_ttl = tonumber(ARGV[2])
+local keys_ttl = tonumber(ARGV[3])
+local count = #KEYS / 6
+
+-- forget dead waiters, check whether this waiter is still in all queues
+local queued = true
+for i = 1, count do
+    local queue_key, heartbeat_key = KEYS[i * 6 - 4], KEYS[i * 6 - 3]
+    local dead = redis.call('ZRANGEBYSCORE', heartbeat_key, '-inf', now_str)
+    for _, member in ipairs(dead) do
+        redis.call('ZREM', queue_key, member)
+    end
+    redis.call('ZREMRANGEBYSCORE', heartbeat_key, '-inf', now_str)
+    if not redis.call('ZSCORE', queue_key, token) then
+        queued = false
+    end
+end
+
+local heartbeat_until = string.format('%.0f', now + heartbeat_ttl * 1000)
+local busy = {}
+local any_busy = false
+for i = 1, count do
+    local holder_key, queue_key = KEYS[i * 6 - 5], KEYS[i * 6 - 4]
+    local heartbeat_key, seq_key = KEYS[i * 6 - 3], KEYS[i * 6 - 1]
+    if not queued then
+        -- (re)enqueue into all queues at once, so combined waiters are in the same order in every queue
+        redis.call('ZREM', queue_key, token)
+        redis.call('ZADD', queue_key, redis.call('INCR', seq_key), token)
+    end
+    redis.call('ZADD', heartbeat_key, heartbeat_until, token)
+    redis.call('EXPIRE', queue_key, keys_ttl)
+    redis.call('EXPIRE', heartbeat_key, keys_ttl)
+    redis.call('EXPIRE', seq_key, keys_ttl)
+
+    if redis.call('GET', holder_key) or redis.call('ZRANGE', queue_key, 0, 0)[1] ~= token then
+        busy[i] = 1
+        any_busy = true
+    else
+        busy[i] = 0
+    end
+end
+if any_busy then
+    return {0, busy}
+end
+
+local delays = {}
+for i = 1, count do
+    redis.call('ZREM', KEYS[i * 6 - 4], token)
+    redis.call('ZREM', KEYS[i * 6 - 3], token)
+    redis.call('DEL', KEYS[i * 6])
+    redis.call('SET', KEYS[i * 6 - 5], token, 'PX', heartbeat_ttl)
+    local ready_time = tonumber(redis.call('GET', KEYS[i * 6 - 2]) or 0)
+    delays[i] = math.max(0, ready_time - now)
+end
+return {1, delays}
+"""
+
+_release_frames_script_map = {}
+_release_frames_script_src = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000000 + tonumber(t[2])
+local keys_ttl = tonumber(ARGV[2])
+
+for i = 1, #KEYS / 3 do
+    if redis.call('GET', KEYS[i * 3 - 2]) == ARGV[1] then
+        redis.call('DEL', KEYS[i * 3 - 2])
+        redis.call('SET', KEYS[i * 3 - 1], string.format('%.0f', now + tonumber(ARGV[i * 2 + 1])), 'EX', keys_ttl)
+        local next_token = redis.call('ZRANGE', KEYS[i * 3], 0, 0)[1]
+        if next_token then
+            local wake_key = ARGV[i * 2 + 2] .. next_token
+            redis.call('RPUSH', wake_key, 1)
+            redis.call('EXPIRE', wake_key, keys_ttl)
+        end
+    end
+end
+return 1
+"""
+
+
+@contextmanager
+def get_time_frames(limiters, key=None):
+    """
+    Acquires time frames of several `FairDistributedLockingRateLimiter` at once with one script call
+    and releases them with one script call. All limiters must use the same Redis client.
+    Combined acquirer waits in FIFO queues of all limiters (it's enqueued into all of them at once)
+    and takes frames when it's the first in every queue and all frames are free.
+    Yields list of seconds waited for each limiter (while it was busy or its rate was exceeded).
+    """
+    if not limiters:
+        yield []
+        return
+
+    client = limiters[0]._client
+    assert all(limiter._client is client for limiter in limiters), 'Limiters must share Redis client'
+    acquire_script = limiters[0]._get_script(_acquire_frames_script_map, _acquire_frames_script_src)
+    release_script = limiters[0]._get_script(_release_frames_script_map, _release_frames_script_src)
+
+    token = uuid.uuid4().hex
+    lock_keys = [limiter._get_lock_key(key) for limiter in limiters]
+    wake_keys = [lock_key + ':wake:' + token for lock_key in lock_keys]
+    acquire_keys = []
+    release_keys = []
+    for lock_key, wake_key in zip(lock_keys, wake_keys):
+        acquire_keys.extend((lock_key + ':holder', lock_key + ':queue', lock_key + ':heartbeat',
+                             lock_key + ':ready', lock_key + ':seq', wake_key))
+        release_keys.extend((lock_key + ':holder', lock_key + ':ready', lock_key + ':queue'))
+    heartbeat_ttl = min(limiter.heartbeat_ttl for limiter in limiters)
+    keys_ttl = max(limiter._keys_ttl for limiter in limiters)
+    timeout = min((limiter.timeout for limiter in limiters if limiter.timeout is not None), default=None)
+    log.debug('Requesting %s time frames...', lock_keys)
+
+    waits = [0] * len(limiters)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        acquired, values = acquire_script(keys=acquire_keys, args=[token, int(heartbeat_ttl * 1000), keys_ttl])
+        if acquired:
+            delays = [delay_us / 1000000 for delay_us in values]
+            break
+
+        wait = heartbeat_ttl / 2
+        if deadline is not None:
+            wait = min(wait, deadline - time.monotonic())
+            if wait <= 0:
+                log.debug('Timeout hit')
+                for limiter, lock_key in zip(limiters, lock_keys):
+                    limiter._leave_script(keys=[lock_key + ':holder', lock_key + ':queue', lock_key + ':heartbeat'],
+                                          args=[token, lock_key + ':wake:', keys_ttl])
+                delays = [0] * len(limiters)
+                break
+
+        # woken up by release of any of limiters, or refreshing heartbeat
+        started_at = time.monotonic()
+        client.blpop(wake_keys, math.floor(wait) if wait >= 1 else wait)
+        waited = time.monotonic() - started_at
+        for i, busy in enumerate(values):
+            if busy:
+                waits[i] += waited
+
+    handles = []
+    if acquired:
+        handles = [limiter._start_heartbeat(lock_key + ':holder', token)
+                   for limiter, lock_key in zip(limiters, lock_keys)]
+
+    delay = max(delays)
+    waits = [wait + delay for wait, delay in zip(waits, delays)]
+    if delay > 0:
+        log.debug('Rate limit hit! Sleeping for %s seconds', delay)
+        time.sleep(delay)
+
+    try:
+        yield waits
+    finally:
+        if acquired:
+            for handle in handles:
+                LongLockRenewer.get_instance().remove(handle)
+            release_args = [token, keys_ttl]
+            for limiter, lock_key in zip(limiters, lock_keys):
+                release_args.extend((round(limiter._min_delay * 1000000), lock_key + ':wake:'))
+            release_script(keys=release_keys, args=release_args)
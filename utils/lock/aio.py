@@ -0,0 +1,365 @@
+"""
+Asyncio variants of `utils.lock` primitives, built on `redis.asyncio`.
+They use the same Redis keys and scripts as blocking ones, so sync and async processes share locks and limits.
+"""
+import time
+import uuid
+import random
+import string
+import asyncio
+import logging
+import contextlib
+
+from utils.lock import (
+    DEFAULT_TIMEOUT, make_lockname, extend_script_src, acquire_many_script_src, release_many_script_src,
+    LongLockHandle, LongLockRenewer, LockingRateLimiter, RateLimiterLease,
+    DistributedRateLimiter as SyncDistributedRateLimiter,
+    DistributedLockingRateLimiter as SyncDistributedLockingRateLimiter,
+)
+from utils.lock.backends import get_default_backend, get_key_backend
+
+log = logging.getLogger(__name__)
+
+
+class RedisLock:
+    """
+    Single node lock compatible with `redlock.RedLock` (same key, value format and release script).
+    """
+
+    clock_drift_factor = 0.01
+    unlock_script_src = """
+    if redis.call("get",KEYS[1]) == ARGV[1] then
+        return redis.call("del",KEYS[1])
+    else
+        return 0
+    end"""
+    _unlock_script_map = {}
+
+    def __init__(self, redis_client, resource, ttl, retry_times=3, retry_delay=200):
+        self.redis_client = redis_client
+        self.resource = resource
+        self.ttl = ttl
+        self.retry_times = retry_times
+        self.retry_delay = retry_delay
+        self.lock_key = None
+        try:
+            self._unlock_script = self._unlock_script_map[redis_client]
+        except KeyError:
+            self._unlock_script = self._unlock_script_map[redis_client] = \
+                redis_client.register_script(self.unlock_script_src)
+
+    @staticmethod
+    def get_unique_id():
+        characters = string.ascii_letters + string.digits
+        return ''.join(random.choice(characters) for _ in range(22)).encode()
+
+    async def acquire(self):
+        self.lock_key = self.get_unique_id()
+        drift = int(self.ttl * self.clock_drift_factor) + 2
+
+        for retry in range(self.retry_times):
+            start_time = time.monotonic()
+            acquired = await self.redis_client.set(self.resource, self.lock_key, nx=True, px=self.ttl)
+            elapsed_time = int((time.monotonic() - start_time) * 1000)
+            if acquired and self.ttl - elapsed_time - drift > 0:
+                return True
+
+            await self.release()
+            await asyncio.sleep(random.randint(0, self.retry_delay) / 1000)
+        return False
+
+    async def release(self):
+        await self._unlock_script(keys=[self.resource], args=[self.lock_key])
+
+
+@contextlib.asynccontextmanager
+async def get_lock(lockname, timeout=DEFAULT_TIMEOUT, retry_times=1, retry_delay=200, redis_client=None,
+                   backend=None):
+    if redis_client is None:
+        redis_client = (backend or get_default_backend()).get_async_client()
+
+    if timeout is None:
+        # same as in blocking version
+        timeout = DEFAULT_TIMEOUT
+
+    lock = RedisLock(redis_client, lockname, retry_times=retry_times, retry_delay=retry_delay, ttl=int(timeout * 1000))
+    got_lock = await lock.acquire()
+    try:
+        yield got_lock
+    finally:
+        if got_lock:
+            await lock.release()
+
+
+@contextlib.asynccontextmanager
+async def get_locks(locknames, timeout=DEFAULT_TIMEOUT, retry_times=1, retry_delay=200, redis_client=None,
+                    backend=None):
+    """
+    See `utils.lock.get_locks`.
+    """
+    locknames = sorted(set(locknames))
+    if not locknames:
+        yield True
+        return
+
+    if redis_client is None:
+        redis_client = (backend or get_default_backend()).get_async_client()
+
+    if timeout is None:
+        timeout = DEFAULT_TIMEOUT
+
+    token = uuid.uuid4().hex
+    ttl = int(timeout * 1000)
+    acquire_script = redis_client.register_script(acquire_many_script_src)
+    release_script = redis_client.register_script(release_many_script_src)
+
+    got_lock = False
+    for retry in range(retry_times):
+        if retry > 0:
+            await asyncio.sleep(random.randint(0, retry_delay) / 1000)
+        got_lock = await acquire_script(keys=locknames, args=[token, ttl]) == 1
+        if got_lock:
+            break
+
+    try:
+        yield got_lock
+    finally:
+        if got_lock:
+            await release_script(keys=locknames, args=[token])
+
+
+@contextlib.asynccontextmanager
+async def get_long_lock(lockname, retry_times=1, retry_delay=200, on_lost=None, redis_client=None,
+                        backend=None):
+    """
+    See `utils.lock.get_long_lock`, TTL is extended by a background task.
+    """
+    from utils import lock as sync_lock
+
+    if redis_client is None:
+        redis_client = (backend or get_default_backend()).get_async_client()
+
+    ttl = int(sync_lock.long_lock_ttl * 1000)
+    lock = RedisLock(redis_client, lockname, retry_times=retry_times, retry_delay=retry_delay, ttl=ttl)
+    got_lock = await lock.acquire()
+    handle = LongLockHandle(lock, got_lock, on_lost)
+
+    if got_lock:
+        update_task = asyncio.create_task(_update_long_lock(handle))
+
+    try:
+        yield handle
+    finally:
+        if got_lock:
+            handle.cancelled = True
+            update_task.cancel()
+            await lock.release()
+
+
+async def _update_long_lock(handle):
+    lock = handle.lock
+    extend_script = lock.redis_client.register_script(extend_script_src)
+    delay = lock.ttl * 0.5 / 1000
+
+    while True:
+        await asyncio.sleep(delay)
+        try:
+            extended = await extend_script(keys=[lock.resource], args=[lock.lock_key, lock.ttl])
+        except Exception:
+            log.exception('Failed to renew long lock %s', lock.resource)
+            if time.monotonic() >= handle.expires_at and not handle.cancelled:
+                handle.mark_lost()
+                return
+            delay = LongLockRenewer.retry_delay
+            continue
+
+        if extended != 1:
+            # released while extending, the key has been deleted by the holder
+            if not handle.cancelled:
+                handle.mark_lost()
+            return
+        handle.expires_at = time.monotonic() + lock.ttl / 1000
+        delay = lock.ttl * 0.5 / 1000
+
+
+def get_lock_function(name_prefix, default_timeout=None, name_separator=':'):
+    @contextlib.asynccontextmanager
+    async def func(*name_parts, **kwargs):
+        timeout = kwargs.get('timeout', default_timeout)
+        lockname = make_lockname(name_prefix, name_parts, name_separator)
+        async with get_lock(lockname, timeout=timeout) as lock:
+            yield lock
+    return func
+
+
+def get_long_lock_function(name_prefix, name_separator=':'):
+    @contextlib.asynccontextmanager
+    async def func(*name_parts, **kwargs):
+        lockname = make_lockname(name_prefix, name_parts, name_separator)
+        async with get_long_lock(lockname) as lock:
+            yield lock
+    return func
+
+
+class DistributedRateLimiter(SyncDistributedRateLimiter):
+    """
+    Asyncio version of `utils.lock.DistributedRateLimiter`, use `await limiter.wait()`.
+    """
+
+    def __init__(self, max_rate_hz, name='', redis_client=None, lease_size=None, backend=None, lease_idle_timeout=1):
+        if redis_client is None:
+            redis_client = (backend or get_default_backend()).get_async_client()
+        super().__init__(max_rate_hz, name, redis_client=redis_client, lease_size=lease_size, backend=backend,
+                         lease_idle_timeout=lease_idle_timeout)
+        self._leases_lock = asyncio.Lock()
+
+    async def wait(self, key=None):
+        if self.lease_size:
+            return await self._wait_leased(key)
+
+        redis_key = self._get_redis_key(key)
+        if key:
+            log.debug('Requesting %s time frame for key %s...', self.name, key)
+        else:
+            log.debug('Requesting %s time frame...', self.name)
+
+        redis_time = float('%d.%06d' % await self._client.time())
+        log.debug('Redis time: %s', redis_time)
+
+        delay = float(await self._script(keys=[redis_key], args=[redis_time, self._min_delay]))
+        await self._sleep(delay, key)
+
+    async def _wait_leased(self, key):
+        redis_key = self._get_redis_key(key)
+
+        async with self._leases_lock:
+            lease = self._leases.get(redis_key)
+            # exhausted lease has no slots to return
+            if lease is None or not lease.take_slot():
+                lease = self._leases[redis_key] = await self._take_lease(redis_key)
+                lease.take_slot()
+                self._ensure_lease_returner()
+            delay = lease.slot_delay
+
+        await self._sleep(delay, key)
+
+    async def _take_lease(self, redis_key):
+        redis_time, first_slot_time, lease_end = await self._lease_script(
+            keys=[redis_key], args=[self._min_delay, self.lease_size])
+        return RateLimiterLease(float(redis_time), float(first_slot_time), self.lease_size, self._min_delay,
+                                lease_end)
+
+    async def _return_lease(self, redis_key, lease):
+        if lease.unused_slots:
+            await self._return_script(keys=[redis_key], args=[lease.lease_end, lease.last_used_slot_time])
+
+    def _ensure_lease_returner(self):
+        if self._lease_returner is None or self._lease_returner.done():
+            self._lease_returner = asyncio.create_task(self._return_idle_leases())
+
+    async def _return_idle_leases(self):
+        while True:
+            await asyncio.sleep(self.lease_idle_timeout)
+            async with self._leases_lock:
+                idle_since = time.monotonic() - self.lease_idle_timeout
+                for redis_key, lease in list(self._leases.items()):
+                    if lease.slot_taken_at <= idle_since:
+                        del self._leases[redis_key]
+                        lease.expire()
+                        try:
+                            await self._return_lease(redis_key, lease)
+                        except Exception:
+                            log.exception('Failed to return unused %s time frames', self.name)
+                if not self._leases:
+                    # started again with next lease
+                    self._lease_returner = None
+                    return
+
+    async def release(self):
+        async with self._leases_lock:
+            leases, self._leases = self._leases, {}
+            for redis_key, lease in leases.items():
+                lease.expire()
+                await self._return_lease(redis_key, lease)
+
+    async def _sleep(self, delay, key):
+        if delay > 0:
+            if key:
+                log.debug('%s rate limit hit for key %s! Sleeping for %s seconds', self.name, key, delay)
+            else:
+                log.debug('%s rate limit hit! Sleeping for %s seconds', self.name, delay)
+            await asyncio.sleep(delay)
+        else:
+            log.debug('Continue without delay')
+
+
+class DistributedLockingRateLimiter(LockingRateLimiter):
+    """
+    Asyncio version of `utils.lock.DistributedLockingRateLimiter`, use `async with limiter.get_time_frame()`.
+    Every waiter holds one Redis connection for blocking BLPOP, size connection pool accordingly.
+    """
+
+    _get_lock_key = SyncDistributedLockingRateLimiter._get_lock_key
+    max_rate_hz = SyncDistributedLockingRateLimiter.max_rate_hz
+
+    def __init__(self, max_rate_hz, name, timeout=60, redis_client=None, backend=None):
+        self._max_rate = self._min_delay = 0
+        super().__init__(max_rate_hz, name)
+        self.timeout = timeout
+
+        if backend is None:
+            # explicit client still gets keys of default backend, so they match processes not passing it
+            backend = get_key_backend() if redis_client is not None else get_default_backend()
+        self._backend = backend
+        if redis_client is None:
+            redis_client = backend.get_async_client()
+        self._client = redis_client
+
+    @contextlib.asynccontextmanager
+    async def get_time_frame(self, key=None):
+        lock_key = self._get_lock_key(key)
+        log.debug('Requesting %s time frame...', lock_key)
+
+        exists_key = lock_key + ':exists'
+        exists = await self._client.getset(exists_key, 1)
+        if self.timeout is not None:
+            await self._client.expire(exists_key, self.timeout)
+
+        if exists is None:
+            log.debug('Lock does not exist, initialize it')
+            await self._client.rpush(lock_key, 0)
+        else:
+            log.debug('Lock already exists, waiting for it')
+
+        blpop_result = await self._client.blpop(lock_key, self.timeout)
+        if blpop_result is not None:
+            ready_time = float(blpop_result[1])
+        else:
+            log.debug('Timeout hit')
+            ready_time = 0
+
+        redis_time = await self.get_current_redis_time()
+        delay = ready_time - redis_time
+        if delay > 0:
+            log.debug('Rate limit hit! Sleeping for %s seconds', delay)
+            await asyncio.sleep(delay)
+        else:
+            log.debug('Continue without delay')
+
+        log.debug('Running job in time frame %s...', lock_key)
+        try:
+            yield
+        finally:
+            log.debug('Job finished in time frame %s', lock_key)
+
+            redis_time = await self.get_current_redis_time()
+            ready_time = redis_time + self._min_delay
+            log.debug('Next free time frame will be at %s', ready_time)
+
+            await self._client.set(exists_key, 1, ex=self.timeout)
+            await self._client.rpush(lock_key, str(ready_time))
+            if self.timeout is not None:
+                await self._client.expire(lock_key, self.timeout)
+
+    async def get_current_redis_time(self):
+        return float('%d.%06d' % await self._client.time())
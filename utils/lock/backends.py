@@ -0,0 +1,136 @@
+"""
+Backends provide Redis clients and key naming for `utils.lock`.
+
+Default backend is resolved lazily on first use: the one set by `set_default_backend()`,
+otherwise `utils.django.lock.DjangoCacheBackend` if Django settings are configured.
+Non-Django processes should call `set_default_backend(RedisURLBackend(url))` on startup.
+"""
+import threading
+
+_default_backend = None
+_default_backend_lock = threading.Lock()
+
+
+class LockBackend:
+    def get_client(self):
+        """
+        Returns blocking `redis.Redis` client.
+        """
+        raise NotImplementedError
+
+    def get_async_client(self):
+        """
+        Returns `redis.asyncio.Redis` client.
+        """
+        raise NotImplementedError
+
+    def make_key(self, key):
+        """
+        Key of locking rate limiters (other keys are used as is for compatibility).
+        """
+        return key
+
+
+class RedisClientBackend(LockBackend):
+    def __init__(self, client, async_client=None):
+        self.client = client
+        self.async_client = async_client
+
+    def get_client(self):
+        return self.client
+
+    def get_async_client(self):
+        if self.async_client is None:
+            raise ValueError('Async Redis client is not provided')
+        return self.async_client
+
+
+class RedisURLBackend(LockBackend):
+    """
+    Connects on first use.
+    """
+
+    def __init__(self, url, **client_kwargs):
+        self.url = url
+        self.client_kwargs = client_kwargs
+        self._client = None
+        self._async_client = None
+        self._lock = threading.Lock()
+
+    def get_client(self):
+        with self._lock:
+            if self._client is None:
+                from redis import Redis
+                self._client = Redis.from_url(self.url, **self.client_kwargs)
+            return self._client
+
+    def get_async_client(self):
+        with self._lock:
+            if self._async_client is None:
+                from redis.asyncio import Redis
+                self._async_client = Redis.from_url(self.url, **self.client_kwargs)
+            return self._async_client
+
+
+class InMemoryBackend(LockBackend):
+    """
+    Process-local Redis emulation for tests and single process tools, requires fakeredis (and lupa for Lua).
+    """
+
+    def __init__(self):
+        import fakeredis
+
+        self._server = fakeredis.FakeServer()
+        self._client = fakeredis.FakeRedis(server=self._server)
+        self._async_client = None
+
+    def get_client(self):
+        return self._client
+
+    def get_async_client(self):
+        if self._async_client is None:
+            import fakeredis
+            self._async_client = fakeredis.FakeAsyncRedis(server=self._server)
+        return self._async_client
+
+
+def set_default_backend(backend):
+    global _default_backend
+
+    with _default_backend_lock:
+        _default_backend = backend
+
+
+def get_default_backend() -> LockBackend:
+    global _default_backend
+
+    with _default_backend_lock:
+        if _default_backend is None:
+            _default_backend = _get_django_backend()
+        return _default_backend
+
+
+def get_key_backend():
+    """
+    Backend naming keys of locking rate limiters created with explicit Redis client:
+    the default one, so keys are prefixed same as without client (e.g. by Django cache key function),
+    or one with unprefixed keys if default backend is not configured.
+    """
+    try:
+        return get_default_backend()
+    except ValueError:
+        return LockBackend()
+
+
+def _get_django_backend():
+    try:
+        from django.conf import settings
+        configured = settings.configured
+    except ImportError:
+        configured = False
+
+    if not configured:
+        raise ValueError('Lock backend is not configured, use utils.lock.backends.set_default_backend()')
+
+    from utils.django.lock import DjangoCacheBackend
+    return DjangoCacheBackend()
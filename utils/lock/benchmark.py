@@ -0,0 +1,157 @@
+"""
+Benchmarks for `utils.lock` rate limiters.
+
+    python -m utils.lock.benchmark [--redis-url redis://localhost/15] [--latency-ms 1]
+
+Without `--redis-url` local Redis stand-in is used (fakeredis, requires lupa for Lua scripts).
+Every Redis command is delayed by `--latency-ms` to emulate network round-trip.
+Locking rate limiters are compared by time frame wait percentiles of `--threads` contending clients.
+"""
+import time
+import argparse
+import threading
+
+from redis import Redis
+from redis.commands.core import Script
+
+from utils.lock import DistributedRateLimiter, DistributedLockingRateLimiter, FairDistributedLockingRateLimiter
+from utils.lock.backends import RedisClientBackend
+
+
+class LatencyClient:
+    """
+    Redis client proxy that delays and counts every command.
+    """
+
+    def __init__(self, client, latency):
+        self._client = client
+        self._latency = latency
+        self._lock = threading.Lock()
+        self.round_trips = 0
+
+    def register_script(self, script):
+        return Script(self, script)
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr) or name in ('get_encoder', 'connection_pool'):
+            return attr
+
+        def command(*args, **kwargs):
+            with self._lock:
+                self.round_trips += 1
+            time.sleep(self._latency)
+            return attr(*args, **kwargs)
+        return command
+
+
+def get_client(redis_url=None):
+    if redis_url:
+        return Redis.from_url(redis_url)
+
+    import fakeredis
+    return fakeredis.FakeRedis()
+
+
+def run_threads(func, threads_count, calls_per_thread):
+    """
+    Returns elapsed time, re-raises the first exception of worker threads.
+    """
+    errors = []
+
+    def target():
+        try:
+            for _ in range(calls_per_thread):
+                func()
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=target) for _ in range(threads_count)]
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return time.perf_counter() - started_at
+
+
+def bench_rate_limiter(client, name, rate_hz, threads_count, calls_per_thread, lease_size=None):
+    limiter = DistributedRateLimiter(rate_hz, name, redis_client=client, lease_size=lease_size)
+    client.round_trips = 0
+    elapsed = run_threads(limiter.wait, threads_count, calls_per_thread)
+    if lease_size:
+        limiter.release()
+
+    calls = threads_count * calls_per_thread
+    return {
+        'mode': f'lease={lease_size}' if lease_size else 'plain',
+        'calls': calls,
+        'elapsed': elapsed,
+        'achieved_hz': calls / elapsed,
+        'round_trips_per_call': client.round_trips / calls,
+    }
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def bench_locking_rate_limiter(client, limiter_class, name, rate_hz, threads_count, calls_per_thread):
+    limiter = limiter_class(rate_hz, name, backend=RedisClientBackend(client))
+    waits = []
+
+    def call():
+        started_at = time.perf_counter()
+        with limiter.get_time_frame():
+            waits.append(time.perf_counter() - started_at)
+
+    client.round_trips = 0
+    elapsed = run_threads(call, threads_count, calls_per_thread)
+
+    calls = threads_count * calls_per_thread
+    return {
+        'mode': limiter_class.__name__,
+        'calls': calls,
+        'elapsed': elapsed,
+        'achieved_hz': calls / elapsed,
+        'round_trips_per_call': client.round_trips / calls,
+        'p50_wait': percentile(waits, 50),
+        'p99_wait': percentile(waits, 99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--redis-url')
+    parser.add_argument('--latency-ms', type=float, default=1)
+    parser.add_argument('--rate', type=float, default=500, help='rate limit, Hz')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--calls', type=int, default=100, help='calls per thread')
+    parser.add_argument('--lease-size', type=int, default=20)
+    args = parser.parse_args()
+
+    client = LatencyClient(get_client(args.redis_url), args.latency_ms / 1000)
+    for lease_size in (None, args.lease_size):
+        name = f'benchmark:{time.time()}'
+        result = bench_rate_limiter(client, name, args.rate, args.threads, args.calls, lease_size=lease_size)
+        print('{mode:>10}: {calls} calls in {elapsed:.3f}s, {achieved_hz:.1f} Hz, '
+              '{round_trips_per_call:.3f} round-trips per call'.format(**result))
+
+    for limiter_class in (DistributedLockingRateLimiter, FairDistributedLockingRateLimiter):
+        name = f'benchmark:{time.time()}'
+        result = bench_locking_rate_limiter(client, limiter_class, name, args.rate, args.threads, args.calls)
+        if result['p50_wait'] is None:
+            print('{mode:>34}: no time frames acquired'.format(**result))
+            continue
+        print('{mode:>34}: {calls} calls in {elapsed:.3f}s, {achieved_hz:.1f} Hz, '
+              '{round_trips_per_call:.3f} round-trips per call, '
+              'wait p50 {p50_wait:.4f}s, p99 {p99_wait:.4f}s'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+import bisect
+import threading
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets (upper bounds), like Prometheus histogram.
+    """
+
+    default_buckets = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def cumulative_counts(self):
+        """
+        Yields (upper bound, cumulative count) pairs, the last upper bound is `float('inf')`.
+        """
+        total = 0
+        for upper_bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield upper_bound, total
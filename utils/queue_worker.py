@@ -7,30 +7,62 @@ import logging
 import os
 from time import sleep, time
 import threading
-from queue import Queue
+from queue import Queue, Full, Empty
+
+from utils.metrics import Histogram
 
 log = logging.getLogger(__name__)
 DEFAULT_TIMEOUT = 10
 
 
+class OverflowPolicy:
+    # jobs queued from the worker thread itself are dropped instead of blocking
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+
+
 class QueueWorkerThread:
     _terminator = object()
+    _drain_at_exit = True
 
-    def __init__(self, thread_name=None, shutdown_timeout=DEFAULT_TIMEOUT):
+    def __init__(self, thread_name=None, shutdown_timeout=DEFAULT_TIMEOUT, maxsize=0, overflow=OverflowPolicy.BLOCK):
         """
         :param thread_name:       will be auto-generated if not specified
         :param shutdown_timeout:  wait after main thread terminated before terminate worker
+        :param maxsize:           max queue size, unbounded if zero
+        :param overflow:          what to do when queue is full, see `OverflowPolicy`
         """
-        self._queue = Queue(-1)
+        self._queue = Queue(maxsize)
         self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
         self._thread = None
         self._thread_name = thread_name
         self._thread_for_pid = None
         self.options = {
             'shutdown_timeout': shutdown_timeout,
+            'overflow': overflow,
         }
+        self.queued_count = 0
+        self.dropped_count = 0
+        self.processed_count = 0
         self.start()
 
+    @property
+    def stats(self):
+        return {
+            'queued': self.queued_count,
+            'dropped': self.dropped_count,
+            'processed': self.processed_count,
+            'size': self._queue.qsize(),
+        }
+
+    def _count(self, queued=0, dropped=0, processed=0):
+        with self._stats_lock:
+            self.queued_count += queued
+            self.dropped_count += dropped
+            self.processed_count += processed
+
     def is_alive(self):
         if self._thread_for_pid != os.getpid():
             return False
@@ -48,7 +80,7 @@ class QueueWorkerThread:
                 return
 
             # wake the processing thread up
-            self._queue.put_nowait(self._terminator)
+            self._put_terminator()
 
             timeout = self.options['shutdown_timeout']
 
@@ -104,7 +136,8 @@ class QueueWorkerThread:
                 self._thread_for_pid = os.getpid()
         finally:
             self._lock.release()
-            atexit.register(self.main_thread_terminated)
+            if self._drain_at_exit:
+                atexit.register(self.main_thread_terminated)
 
     def stop(self, timeout=None):
         """
@@ -112,14 +145,67 @@ class QueueWorkerThread:
         """
         with self._lock:
             if self._thread:
-                self._queue.put_nowait(self._terminator)
+                self._put_terminator()
                 self._thread.join(timeout=timeout)
                 self._thread = None
                 self._thread_for_pid = None
 
+    def _put_terminator(self):
+        # terminator must not be blocked or dropped, make room for it dropping oldest jobs
+        if self.options['overflow'] == OverflowPolicy.BLOCK and threading.current_thread() is not self._thread:
+            try:
+                self._queue.put(self._terminator, timeout=self.options['shutdown_timeout'])
+                return
+            except Full:
+                pass
+
+        while True:
+            try:
+                self._queue.put_nowait(self._terminator)
+            except Full:
+                log.warning('Queue of %s is full on shutdown, dropping oldest job', self._thread_name)
+                self._drop_oldest()
+            else:
+                return
+
+    def _drop_oldest(self):
+        try:
+            oldest = self._queue.get_nowait()
+        except Empty:
+            return
+        self._queue.task_done()
+        if oldest is self._terminator:
+            self._put_terminator()
+        else:
+            self._count(dropped=1)
+
+    def _put(self, record):
+        overflow = self.options['overflow']
+        if overflow == OverflowPolicy.BLOCK and threading.current_thread() is not self._thread:
+            self._queue.put(record)
+            self._count(queued=1)
+            return
+
+        while True:
+            try:
+                self._queue.put_nowait(record)
+            except Full:
+                if overflow == OverflowPolicy.BLOCK:
+                    # job queued from the worker itself would wait for its own queue forever
+                    log.warning('Queue of %s is full, dropping job queued from its worker', self._thread_name)
+                    self._count(dropped=1)
+                    return
+                if overflow == OverflowPolicy.DROP_NEWEST:
+                    self._count(dropped=1)
+                    return
+                self._drop_oldest()
+            else:
+                self._count(queued=1)
+                return
+
     def queue(self, callback, *args, **kwargs):
         self._ensure_thread()
-        self._queue.put_nowait((callback, args, kwargs))
+        self._put((callback, args, kwargs))
 
     def _target(self):
         while True:
@@ -133,7 +219,122 @@ class QueueWorkerThread:
                     callback(*args, **kwargs)
                 except Exception:
                     log.error('Failed processing job', exc_info=True)
+                self._count(processed=1)
             finally:
                 self._queue.task_done()
 
             sleep(0)
+
+
+class BatchQueueWorkerThread(QueueWorkerThread):
+    """
+    Collects up to `batch_size` items or items queued within `batch_timeout` seconds
+    and passes them as list to `batch_callback`.
+    """
+
+    def __init__(self, batch_callback, batch_size=100, batch_timeout=0.1, **kwargs):
+        self.batch_callback = batch_callback
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        super().__init__(**kwargs)
+
+    def queue(self, item):
+        self._ensure_thread()
+        self._put(item)
+
+    def _target(self):
+        terminated = False
+        while not terminated:
+            batch = []
+            records_count = 0
+            record = self._queue.get()
+            deadline = time() + self.batch_timeout
+            try:
+                while True:
+                    records_count += 1
+                    if record is self._terminator:
+                        terminated = True
+                        break
+                    batch.append(record)
+                    if len(batch) >= self.batch_size:
+                        break
+                    try:
+                        record = self._queue.get(timeout=max(deadline - time(), 0))
+                    except Empty:
+                        break
+
+                if batch:
+                    # noinspection PyBroadException
+                    try:
+                        self.batch_callback(batch)
+                    except Exception:
+                        log.error('Failed processing batch', exc_info=True)
+                    self._count(processed=len(batch))
+            finally:
+                for _ in range(records_count):
+                    self._queue.task_done()
+
+            sleep(0)
+
+
+class QueueWorkerPool:
+    """
+    Pool of `workers_count` worker threads, each one with its own queue.
+    Jobs with the same `_routing_key` go to the same worker and are processed in order,
+    jobs without key go to the worker with the fewest pending jobs.
+    """
+
+    def __init__(self, workers_count=4, thread_name=None, shutdown_timeout=DEFAULT_TIMEOUT,
+                 time_in_queue_buckets=Histogram.default_buckets, **kwargs):
+        """
+        :param thread_name:       prefix of worker thread names
+        :param shutdown_timeout:  wait after main thread terminated before terminate workers
+        :param kwargs:            passed to every `QueueWorkerThread`
+        """
+        thread_name = thread_name or 'QueueWorkerPool'
+        self.workers = [_PoolWorkerThread(thread_name=f'{thread_name}-{i}', shutdown_timeout=shutdown_timeout, **kwargs)
+                        for i in range(workers_count)]
+        self.shutdown_timeout = shutdown_timeout
+        self.time_in_queue = Histogram(time_in_queue_buckets)
+        atexit.register(self.main_thread_terminated)
+
+    @property
+    def stats(self):
+        return [worker.stats for worker in self.workers]
+
+    def queue(self, callback, *args, _routing_key=None, **kwargs):
+        if _routing_key is None:
+            worker = min(self.workers, key=lambda w: w._queue.unfinished_tasks)
+        else:
+            worker = self.workers[hash(_routing_key) % len(self.workers)]
+        worker.queue(self._call, time(), callback, args, kwargs)
+
+    def _call(self, queued_at, callback, args, kwargs):
+        self.time_in_queue.observe(time() - queued_at)
+        callback(*args, **kwargs)
+
+    def main_thread_terminated(self):
+        """
+        Drains all workers concurrently within `shutdown_timeout`.
+        """
+        alive_workers = []
+        for worker in self.workers:
+            with worker._lock:
+                if worker.is_alive():
+                    worker._put_terminator()
+                    alive_workers.append(worker)
+
+        deadline = time() + self.shutdown_timeout
+        for worker in alive_workers:
+            if not worker._timed_queue_join(max(deadline - time(), 0)):
+                log.debug('Worker %s has not finished pending tasks', worker._thread_name)
+            worker._thread = None
+
+    def stop(self, timeout=None):
+        for worker in self.workers:
+            worker.stop(timeout=timeout)
+
+
+class _PoolWorkerThread(QueueWorkerThread):
+    # pool drains all workers at once
+    _drain_at_exit = False
@@ -1,6 +1,8 @@
 from django.core.cache import cache as django_cache
 from redis import Redis
 
+_async_client = None
+
 
 def get_redis_connection() -> Redis:
     try:
@@ -9,3 +11,19 @@ def get_redis_connection() -> Redis:
         raise ValueError('Unable to get Redis connection') from e
     assert isinstance(client, Redis), 'Redis is expected as default cache backend'
     return client
+
+
+def get_async_redis_connection():
+    """
+    Returns `redis.asyncio.Redis` client connected to the same server as `get_redis_connection()`.
+    """
+    global _async_client
+
+    if _async_client is None:
+        from redis import asyncio as redis_asyncio
+
+        sync_pool = get_redis_connection().connection_pool
+        connection_class = getattr(redis_asyncio.connection, sync_pool.connection_class.__name__)
+        pool = redis_asyncio.ConnectionPool(connection_class=connection_class, **sync_pool.connection_kwargs)
+        _async_client = redis_asyncio.Redis(connection_pool=pool)
+    return _async_client
@@ -1,5 +1,8 @@
 import os
+import gzip
+import math
 import stat
+import bisect
 import time
 import socket
 import atexit
@@ -8,11 +11,15 @@ import logging
 import tempfile
 import threading
 import contextlib
+import concurrent.futures
 import http.server
 import dataclasses
 import collections
 import socketserver
 
+from utils.metrics import Histogram
+from .shared_memory import SharedMemorySegment, is_alive
+
 log = logging.getLogger(__name__)
 
 
@@ -21,14 +28,67 @@ class Metrics:
     metric_type: str
     pid: int
     tid: int
-    idle_seconds_total: float
+    value: float
+
+
+@dataclasses.dataclass
+class LatencyMetrics:
+    pid: int
+    route: str
+    status: str
+    counts: typing.Sequence[float]  # per bucket, the last one is +Inf
+    sum: float
 
 
 class IdleCounter:
-    def __init__(self, app, *, ipc_filename_prefix='wsgi_worker.', prometheus_metrics_address=None):
+    """
+    Counts idle and busy time and requests of every worker thread,
+    and request latency by route template (`_smp_route` in environ) and status class.
+    Metrics of all workers are collected from per-worker Unix sockets or, with `shared_memory`,
+    from memory-mapped files (`shared_memory_filename` suffixed with their layout) without any IPC.
+
+    With `shared_memory` utilisation (busy fraction of all worker threads over last `utilization_window` seconds)
+    is exported as gauge. With `shed_utilization` requests get fast 503 response with `Retry-After` header
+    while utilisation is above it, except paths ending with `shed_exempt_paths`. Utilisation is sampled
+    every `utilization_interval` seconds in background thread of every process using it, requests and scrapes
+    only read it. Sampling needs metrics of all workers, which is cheap only in shared memory,
+    so shedding requires `shared_memory`.
+
+    In socket mode workers are scraped in parallel, workers that don't answer in `scrape_timeout` seconds
+    are reported as timed out. Sockets of dead workers are removed by scraping process
+    at most every `sweep_interval` seconds.
+    """
+
+    def __init__(self, app, *, ipc_filename_prefix='wsgi_worker.', prometheus_metrics_address=None,
+                 latency_buckets=Histogram.default_buckets,
+                 shared_memory=False, shared_memory_filename='wsgi_metrics.shm', shared_memory_slots=256,
+                 shared_memory_latency_slots=1024, utilization_window=60, utilization_interval=1,
+                 scrape_timeout=1, scrape_max_threads=64, sweep_interval=60, exposition_ttl=1,
+                 shed_utilization=None, shed_retry_after=1, shed_exempt_paths=('/healthz', '/metricz')):
         self.app = app
         self.ipc_filename_prefix = ipc_filename_prefix
+        self.scrape_timeout = scrape_timeout
+        self.scrape_max_threads = scrape_max_threads
+        self.sweep_interval = sweep_interval
+        self._swept_at = -math.inf
         self.thread_status_map = collections.defaultdict(WorkerStatus)
+        if shed_utilization is not None and not shared_memory:
+            raise ValueError('shed_utilization requires shared_memory')
+        self.shared_memory = self.latency_shared_memory = None
+        if shared_memory:
+            filename = os.path.join(tempfile.gettempdir(), shared_memory_filename)
+            self.shared_memory = SharedMemorySegment(filename, shared_memory_slots)
+            self.latency_shared_memory = SharedMemorySegment(
+                filename + '.latency', shared_memory_latency_slots,
+                values_count=len(latency_buckets) + 2, label_size=LATENCY_LABEL_SIZE)
+        self.latency = RequestLatency(latency_buckets, self.latency_shared_memory)
+        self.utilization = UtilizationWindow(self.read_metrics, utilization_window, utilization_interval)
+        self._utilization_sampler_lock = threading.Lock()
+        self._utilization_sampler_pid = None
+        self.exposition = MetricsExposition(self, exposition_ttl)
+        self.shed_utilization = shed_utilization
+        self.shed_retry_after = shed_retry_after
+        self.shed_exempt_paths = tuple(shed_exempt_paths)
         if prometheus_metrics_address:
             self.prometheus_metrics_server_thread = PrometheusMetricsHttpServerThread(self, prometheus_metrics_address)
             self.prometheus_metrics_server_thread.start()
@@ -36,10 +96,31 @@ class IdleCounter:
     def _init(self):
         # Can't put this in __init__, because `gunicorn --preload` will start the thread in master process before fork.
         # Using deferred initialization instead.
+        if self.shared_memory is not None:
+            pid = os.getpid()
+            for segment in (self.shared_memory, self.latency_shared_memory):
+                segment.open()
+                atexit.register(segment.release, pid)
+            if self.shed_utilization is not None:
+                self.ensure_utilization_sampler()
+            return
+
         ipc_filename = os.path.join(tempfile.gettempdir(), self.ipc_filename_prefix + str(os.getpid()))
-        self.thread = SiblingIPCServerThread(ipc_filename, self.thread_status_map)
+        self.thread = SiblingIPCServerThread(ipc_filename, self.thread_status_map, self.latency)
         self.thread.start()
 
+    def ensure_utilization_sampler(self):
+        """
+        Starts utilisation sampler thread once per process, only with shared memory.
+        """
+        if self.shared_memory is None:
+            return
+        with self._utilization_sampler_lock:
+            if self._utilization_sampler_pid != os.getpid():
+                self.utilization_sampler_thread = UtilizationSamplerThread(self.utilization)
+                self.utilization_sampler_thread.start()
+                self._utilization_sampler_pid = os.getpid()
+
     def __call__(self, environ, start_response):
         if environ.get('_smp_preinit'):
             # skip on preinit, otherwise it will negate the idea of deferred initialization
@@ -49,30 +130,241 @@ class IdleCounter:
             self._init()
             self._init = None
 
+        if self.shed_utilization is not None and self._should_shed(environ):
+            start_response('503 Service Unavailable', [
+                ('Content-Type', 'text/plain'),
+                ('Retry-After', str(self.shed_retry_after)),
+            ])
+            return [b'Overloaded']
+
         tid = threading.get_native_id()
-        status = self.thread_status_map[tid]
-        with status.count_request_time():
-            return self.app(environ, start_response)
+        status = self.thread_status_map.get(tid)
+        if status is None:
+            status = self.thread_status_map[tid] = self._make_worker_status(tid)
 
-    def read_metrics(self) -> typing.Iterable[Metrics]:
-        return read_all_metrics(tempfile.gettempdir(), self.ipc_filename_prefix)
+        response_status = None
+
+        def _start_response(status, *args):
+            nonlocal response_status
+            response_status = status
+            return start_response(status, *args)
+
+        started_at = time.perf_counter()
+        try:
+            with status.count_request_time():
+                return self.app(environ, _start_response)
+        finally:
+            status_class = f'{response_status[0]}xx' if response_status else '5xx'
+            self.latency.observe(environ.get('_smp_route', ''), status_class, time.perf_counter() - started_at)
+
+    def _should_shed(self, environ):
+        if environ.get('PATH_INFO', '').rstrip('/').endswith(self.shed_exempt_paths):
+            return False
+        return self.utilization.get() > self.shed_utilization
+
+    def _make_worker_status(self, tid):
+        if self.shared_memory is None:
+            return WorkerStatus()
+        try:
+            slot = self.shared_memory.allocate(os.getpid(), tid)
+        except OverflowError:
+            log.warning('No free shared memory slots, metrics of thread %s are not exported', tid)
+            slot = None
+        return WorkerStatus(slot)
+
+    def maybe_sweep(self):
+        """
+        Removes sockets of dead workers if last sweep is older than `sweep_interval`, called on scrape.
+        """
+        if self.shared_memory is not None or not self.sweep_interval \
+                or time.monotonic() - self._swept_at < self.sweep_interval:
+            return
+        self._swept_at = time.monotonic()
+        try:
+            sweep_stale_sockets(tempfile.gettempdir(), self.ipc_filename_prefix)
+        except Exception:
+            log.exception('Failed to sweep stale sockets')
+
+    def read_metrics(self) -> typing.Iterable[typing.Union[Metrics, LatencyMetrics]]:
+        if self.shared_memory is not None:
+            yield from read_shared_memory_metrics(self.shared_memory)
+            yield from read_shared_memory_latency_metrics(self.latency_shared_memory)
+        else:
+            yield from read_all_metrics(tempfile.gettempdir(), self.ipc_filename_prefix, self.scrape_timeout,
+                                        self.scrape_max_threads)
+
+
+LATENCY_LABEL_SIZE = 200
+
+
+class RequestLatency:
+    """
+    Request latency histograms of this process by (route template, status class).
+    """
+
+    def __init__(self, buckets, shared_memory=None):
+        self.buckets = tuple(sorted(buckets))
+        self.shared_memory = shared_memory
+        self.histograms = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def observe(self, route, status, seconds):
+        key = (route, status)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self._add(key)
+
+        idx = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram.counts[idx] += 1
+            histogram.sum += seconds
+            slot = self._slots.get(key)
+            if slot is not None:
+                slot.write(*histogram.counts, histogram.sum)
+
+    def _add(self, key):
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is not None:
+                return histogram
+
+            histogram = Histogram(self.buckets)
+            if self.shared_memory is not None:
+                route, status = key
+                try:
+                    label = f'{status}:{route}'.encode('utf8')
+                    self._slots[key] = self.shared_memory.allocate(os.getpid(), 0, label)
+                except OverflowError:
+                    log.warning('No free shared memory slots, latency of %s %s is not exported', route, status)
+            self.histograms[key] = histogram
+            return histogram
+
+    def items(self):
+        with self._lock:
+            return [(key, list(histogram.counts), histogram.sum) for key, histogram in self.histograms.items()]
+
+
+class UtilizationWindow:
+    """
+    Busy fraction of all worker threads over last `window` seconds.
+    Busy and total time deltas between samples are kept in ring buffer of `window / interval` samples.
+    """
+
+    def __init__(self, read_metrics, window=60, interval=1):
+        self.read_metrics = read_metrics
+        self.window = window
+        self.interval = interval
+        size = max(1, math.ceil(window / interval))
+        self._sampled_at = [-math.inf] * size
+        self._busy = [0.0] * size
+        self._total = [0.0] * size
+        self._index = 0
+        self._last_totals = {}
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def update(self, metrics):
+        """
+        Adds sample from idle and busy `Metrics` of all threads.
+        """
+        totals = {}
+        for m in metrics:
+            if isinstance(m, Metrics) and m.metric_type in ('idle', 'busy'):
+                totals.setdefault((m.pid, m.tid), [0, 0])[m.metric_type == 'busy'] = m.value
+
+        busy = total = 0
+        with self._lock:
+            for key, (idle_seconds, busy_seconds) in totals.items():
+                last = self._last_totals.get(key)
+                if last is None:
+                    # new thread, whole its lifetime is outside of window
+                    continue
+                busy_delta = max(0, busy_seconds - last[1])
+                busy += busy_delta
+                total += busy_delta + max(0, idle_seconds - last[0])
+            self._last_totals = totals
+
+            self._index = (self._index + 1) % len(self._busy)
+            self._sampled_at[self._index] = time.monotonic()
+            self._busy[self._index] = busy
+            self._total[self._index] = total
+        self._value = self.value()
+
+    def sample(self):
+        self.update(list(self.read_metrics()))
+
+    def get(self):
+        """
+        Returns utilisation from 0 to 1 as of the last sample, doesn't read metrics of workers.
+        """
+        return self._value
+
+    def value(self):
+        since = time.monotonic() - self.window
+        busy = total = 0
+        with self._lock:
+            for sampled_at, sample_busy, sample_total in zip(self._sampled_at, self._busy, self._total):
+                if sampled_at >= since:
+                    busy += sample_busy
+                    total += sample_total
+        return busy / total if total else 0.0
+
+
+class UtilizationSamplerThread(threading.Thread):
+    """
+    Samples `UtilizationWindow` every `interval` seconds, so request handling doesn't wait for other workers.
+    """
+
+    def __init__(self, utilization):
+        self.utilization = utilization
+        super().__init__(name='IdleCounter_UtilizationSamplerThread', daemon=True)
+
+    def run(self):
+        while True:
+            try:
+                self.utilization.sample()
+            except Exception:
+                log.exception('Failed to sample utilisation')
+            time.sleep(self.utilization.interval)
 
 
 class WorkerStatus:
-    def __init__(self):
+    def __init__(self, slot=None):
         self._idle_seconds_total = 0
         self._busy_seconds_total = 0
+        self.requests_total = 0
         self.request_started_at = self.request_ended_at = time.time()
+        self.slot = slot
+        self._write_slot()
+
+    @classmethod
+    def restore(cls, idle_seconds_total, busy_seconds_total, request_started_at, request_ended_at, requests_total):
+        status = cls()
+        status._idle_seconds_total = idle_seconds_total
+        status._busy_seconds_total = busy_seconds_total
+        status.request_started_at = request_started_at
+        status.request_ended_at = request_ended_at
+        status.requests_total = requests_total
+        return status
+
+    def _write_slot(self):
+        if self.slot is not None:
+            self.slot.write(self._idle_seconds_total, self._busy_seconds_total,
+                            self.request_started_at, self.request_ended_at, self.requests_total)
 
     @contextlib.contextmanager
     def count_request_time(self):
         try:
+            self.requests_total += 1
             self.request_started_at = time.time()
             self._idle_seconds_total += self.request_started_at - self.request_ended_at
+            self._write_slot()
             yield
             self._busy_seconds_total += time.time() - self.request_started_at
         finally:
             self.request_ended_at = time.time()
+            self._write_slot()
 
     @property
     def in_request(self):
@@ -94,20 +386,31 @@ class WorkerStatus:
 
 
 class SiblingIPCServerThread(threading.Thread):
-    def __init__(self, filename, thread_status_map):
+    def __init__(self, filename, thread_status_map, latency=None):
         self.filename = filename
         self.thread_status_map = thread_status_map
+        self.latency = latency
         super().__init__(name='IdleCounter_SiblingIPCServerThread', daemon=True)
 
     def run(self):
         class Handler(socketserver.BaseRequestHandler):
             def handle(handler):
                 pid = os.getpid()
-                for tid, status in self.thread_status_map.items():
+                for tid, status in list(self.thread_status_map.items()):
                     row = f'idle:{pid}:{tid}:{status.idle_seconds_total}\n'
                     handler.request.sendall(row.encode('ascii'))
                     row = f'busy:{pid}:{tid}:{status.busy_seconds_total}\n'
                     handler.request.sendall(row.encode('ascii'))
+                    row = f'requests:{pid}:{tid}:{status.requests_total}\n'
+                    handler.request.sendall(row.encode('ascii'))
+                    row = f'in_flight:{pid}:{tid}:{int(status.in_request)}\n'
+                    handler.request.sendall(row.encode('ascii'))
+                if self.latency is not None:
+                    for (route, status), counts, total in self.latency.items():
+                        counts = ','.join(map(str, counts))
+                        # route goes last, it may contain colons
+                        row = f'latency:{pid}:{status}:{total}:{counts}:{route}\n'
+                        handler.request.sendall(row.encode('utf8'))
 
         self.cleanup()
         atexit.register(self.cleanup)
@@ -135,36 +438,230 @@ class PrometheusMetricsHttpServerThread(threading.Thread):
 
         class Handler(http.server.BaseHTTPRequestHandler):
             def do_GET(self):
+                use_gzip = accepts_gzip(self.headers.get('Accept-Encoding', ''))
+                body = idle_counter.exposition.get(use_gzip)
                 self.send_response(200)
-                self.send_header('Content-type', 'text/plain')
+                self.send_header('Content-Type', MetricsExposition.content_type)
+                if use_gzip:
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Vary', 'Accept-Encoding')
+                self.send_header('Content-Length', str(len(body)))
                 self.end_headers()
-                for metric in self.format_metrics():
-                    self.wfile.write(f'{metric}\n'.encode('utf8'))
+                self.wfile.write(body)
 
-            def format_metrics(self):
-                yield '# TYPE idle_seconds_total summary'
-                yield '# TYPE busy_seconds_total summary'
-                for metrics in idle_counter.read_metrics():
-                    metric_name = f'{metrics.metric_type}_seconds_total'
-                    yield f'{metric_name}{{pid="{metrics.pid}",tid="{metrics.tid}"}} {metrics.idle_seconds_total}'
+            def log_message(self, format, *args):
+                log.debug(format, *args)
 
         log.info('Starting Prometheus metrics HTTP server')
         server = http.server.ThreadingHTTPServer(self.address, Handler)
         server.serve_forever()
 
 
+class MetricsExposition:
+    """
+    Prometheus text exposition of `format_metrics`, cached for `ttl` seconds,
+    so concurrent and repeated scrapes (e.g. by several Prometheus replicas) read metrics of workers once.
+    """
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, idle_counter, ttl=1):
+        self.idle_counter = idle_counter
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._expires_at = 0
+        self._body = self._gzipped_body = None
+
+    def get(self, use_gzip=False) -> bytes:
+        with self._lock:
+            if time.monotonic() >= self._expires_at:
+                self.idle_counter.maybe_sweep()
+                self.idle_counter.ensure_utilization_sampler()
+                self._body = ''.join(f'{line}\n' for line in format_metrics(self.idle_counter)).encode('utf8')
+                self._gzipped_body = None
+                self._expires_at = time.monotonic() + self.ttl
+            if not use_gzip:
+                return self._body
+            if self._gzipped_body is None:
+                self._gzipped_body = gzip.compress(self._body, compresslevel=5)
+            return self._gzipped_body
+
+
+def accepts_gzip(accept_encoding):
+    """
+    Whether `Accept-Encoding` header value allows gzip: listed or matched by `*` with non-zero q-value.
+    """
+    q_values = {}
+    for item in accept_encoding.split(','):
+        coding, *params = item.split(';')
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        q_values[coding.strip().lower()] = q
+    return q_values.get('gzip', q_values.get('*', 0.0)) > 0
+
+
+def format_metrics(idle_counter):
+    """
+    Yields lines of Prometheus text exposition of metrics of all workers.
+    Request latency and in-flight requests are aggregated across workers.
+    """
+    yield '# TYPE idle_seconds_total summary'
+    yield '# TYPE busy_seconds_total summary'
+    yield '# TYPE requests_total counter'
+    yield '# TYPE worker_scrape_timeout gauge'
+    in_flight = 0
+    latency = {}
+    for metrics in idle_counter.read_metrics():
+        if isinstance(metrics, LatencyMetrics):
+            key = (metrics.route, metrics.status)
+            counts, total = latency.get(key) or ([0] * len(metrics.counts), 0)
+            latency[key] = [a + b for a, b in zip(counts, metrics.counts)], total + metrics.sum
+        elif metrics.metric_type == 'in_flight':
+            in_flight += metrics.value
+        elif metrics.metric_type == 'scrape_timeout':
+            yield f'worker_scrape_timeout{{pid="{metrics.pid}"}} {int(metrics.value)}'
+        elif metrics.metric_type == 'requests':
+            yield f'requests_total{{pid="{metrics.pid}",tid="{metrics.tid}"}} {int(metrics.value)}'
+        else:
+            metric_name = f'{metrics.metric_type}_seconds_total'
+            yield f'{metric_name}{{pid="{metrics.pid}",tid="{metrics.tid}"}} {metrics.value}'
+
+    yield '# TYPE in_flight_requests gauge'
+    yield f'in_flight_requests {int(in_flight)}'
+
+    if idle_counter.shared_memory is not None:
+        yield '# TYPE worker_utilization gauge'
+        yield f'worker_utilization {idle_counter.utilization.value()}'
+
+    yield '# TYPE request_duration_seconds histogram'
+    buckets = idle_counter.latency.buckets + (float('inf'),)
+    for (route, status), (counts, total) in sorted(latency.items()):
+        labels = f'route="{escape_label_value(route)}",status="{status}"'
+        cumulative = 0
+        for upper_bound, count in zip(buckets, counts):
+            cumulative += count
+            le = '+Inf' if upper_bound == float('inf') else upper_bound
+            yield f'request_duration_seconds_bucket{{{labels},le="{le}"}} {int(cumulative)}'
+        yield f'request_duration_seconds_sum{{{labels}}} {total}'
+        yield f'request_duration_seconds_count{{{labels}}} {int(cumulative)}'
+
+
+def escape_label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
 def is_socket(filename):
     return stat.S_ISSOCK(os.stat(filename).st_mode)
 
 
-def read_all_metrics(dirname, fileprefix):
+def sweep_stale_sockets(dirname, fileprefix):
+    """
+    Removes IPC sockets of workers that are not alive anymore (e.g. killed with SIGKILL).
+    """
     for filename in os.listdir(dirname):
-        if filename.startswith(fileprefix):
-            yield from read_worker_metrics(os.path.join(dirname, filename))
+        pid = _parse_pid(filename, fileprefix)
+        if pid is None or is_alive(pid):
+            continue
+        path = os.path.join(dirname, filename)
+        try:
+            if is_socket(path):
+                os.remove(path)
+                log.info('Removed stale socket %s', path)
+        except OSError:
+            pass
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor(max_threads):
+    """
+    Executor is created on first scrape and never shut down (other threads may be submitting to it),
+    its threads are started on demand, so there are no more of them than workers scraped at once.
+    """
+    global _executor, _executor_pid
+    with _executor_lock:
+        # threads of executor don't survive fork
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = concurrent.futures.ThreadPoolExecutor(max_threads, thread_name_prefix='IdleCounter_Scrape')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _parse_pid(filename, fileprefix):
+    if not filename.startswith(fileprefix):
+        return None
+    try:
+        return int(filename[len(fileprefix):])
+    except ValueError:
+        return None
+
+
+def read_all_metrics(dirname, fileprefix, timeout=None, max_threads=64):
+    """
+    Reads metrics of all workers in parallel (up to `max_threads` at once), every worker is reported
+    with `scrape_timeout` metric, which is 1 if worker hasn't answered in `timeout` seconds.
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    executor = _get_executor(max_threads)
+    futures = {}
+    for filename in os.listdir(dirname):
+        pid = _parse_pid(filename, fileprefix)
+        if pid is not None:
+            path = os.path.join(dirname, filename)
+            futures[executor.submit(lambda path=path: list(read_worker_metrics(path, deadline)))] = pid
+
+    concurrent.futures.wait(futures, timeout=timeout)
+    for future, pid in futures.items():
+        timed_out = True
+        if future.done():
+            try:
+                metrics = future.result()
+                if not metrics and not is_alive(pid):
+                    # stale socket
+                    continue
+                yield from metrics
+                timed_out = False
+            except socket.timeout:
+                pass
+            except OSError as e:
+                log.warning('Failed to read metrics of worker %s: %r', pid, e)
+                continue
+        else:
+            future.cancel()
+        yield Metrics('scrape_timeout', pid, 0, int(timed_out))
+
+
+def read_shared_memory_metrics(segment):
+    for pid, tid, _, values in segment.read():
+        status = WorkerStatus.restore(*values)
+        yield Metrics('idle', pid, tid, status.idle_seconds_total)
+        yield Metrics('busy', pid, tid, status.busy_seconds_total)
+        yield Metrics('requests', pid, tid, status.requests_total)
+        yield Metrics('in_flight', pid, tid, int(status.in_request))
+
+
+def read_shared_memory_latency_metrics(segment):
+    for pid, _, label, values in segment.read():
+        status, route = label.decode('utf8', 'replace').split(':', 1)
+        yield LatencyMetrics(pid, route, status, values[:-1], values[-1])
 
 
-def read_worker_metrics(filename):
+def read_worker_metrics(filename, deadline=None):
+    """
+    `deadline` is `time.monotonic()` value, `socket.timeout` is raised after it.
+    """
     with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        if deadline is not None:
+            sock.settimeout(max(0.0, deadline - time.monotonic()))
         try:
             sock.connect(filename)
         except ConnectionRefusedError:
@@ -175,7 +672,14 @@ def read_worker_metrics(filename):
                 pass
             return
 
-        fp = sock.makefile('r')
+        fp = sock.makefile('r', encoding='utf8')
         for line in fp:
+            if deadline is not None and time.monotonic() > deadline:
+                raise socket.timeout()
+            line = line.rstrip('\n')
+            if line.startswith('latency:'):
+                _, pid, status, total, counts, route = line.split(':', 5)
+                yield LatencyMetrics(int(pid), route, status, [float(c) for c in counts.split(',')], float(total))
+                continue
             metric_type, pid, tid, idle_time = line.split(':')
             yield Metrics(metric_type, int(pid), int(tid), float(idle_time))
@@ -0,0 +1,176 @@
+"""
+Fixed-layout memory-mapped file with one slot per (pid, tid, label) of WSGI workers.
+
+Every slot is written only by its owner thread using seqlock: sequence number is odd while slot is being written,
+readers retry until they see the same even sequence number before and after reading values.
+Slots are allocated under `flock`, slots of dead processes are reused.
+
+Layout is part of filename, so segments of other layout (e.g. of previous deploy still running) use other file.
+File is never truncated once initialised, processes may still have it mapped.
+"""
+import os
+import mmap
+import fcntl
+import struct
+import typing
+import logging
+import contextlib
+
+MAGIC = b'SMPWSGI1'
+HEADER = struct.Struct('<8sIII')  # magic, slots count, values count per slot, label size
+SEQ = struct.Struct('<Q')
+READ_RETRIES = 100
+
+log = logging.getLogger(__name__)
+
+
+class SharedMemorySegment:
+    def __init__(self, filename, slots_count=256, values_count=5, label_size=0):
+        self.filename = f'{filename}.{slots_count}x{values_count}x{label_size}'
+        self.slots_count = slots_count
+        self.values_count = values_count
+        self.label_size = label_size
+        self.slot_header = struct.Struct(f'<Qqq{label_size}s')  # sequence, pid, tid, label
+        self.values_struct = struct.Struct(f'<{values_count}d')
+        self.slot_size = self.slot_header.size + self.values_struct.size
+        self.size = HEADER.size + self.slot_size * slots_count
+        self._fd = None
+        self._mmap = None
+        self._pid = None
+
+    def open(self):
+        if self._mmap is not None:
+            if self._pid == os.getpid():
+                return
+            # inherited from parent: flock is held per open file, so locks wouldn't exclude parent
+            self.close()
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            with _flock(fd):
+                header = os.pread(fd, HEADER.size, 0)
+                if not header.strip(b'\0'):
+                    # new file, or its initialisation was interrupted before header was written
+                    os.ftruncate(fd, self.size)
+                    os.pwrite(fd, self._pack_header(), 0)
+                elif header != self._pack_header() or os.fstat(fd).st_size != self.size:
+                    # live processes may have it mapped, truncating it would crash them with SIGBUS
+                    log.error('Shared memory file %s has unexpected layout, refusing to truncate it', self.filename)
+                    raise ValueError(f'{self.filename} has unexpected layout')
+            self._mmap = mmap.mmap(fd, self.size)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+        self._pid = os.getpid()
+
+    def _pack_header(self):
+        return HEADER.pack(MAGIC, self.slots_count, self.values_count, self.label_size)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            os.close(self._fd)
+            self._mmap = self._fd = None
+
+    def _slot_offset(self, index):
+        return HEADER.size + index * self.slot_size
+
+    def allocate(self, pid, tid, label=b'') -> 'SharedMemorySlot':
+        """
+        `label` is truncated to `label_size` bytes.
+        """
+        label = label[:self.label_size]
+        self.open()
+        with _flock(self._fd):
+            for index in range(self.slots_count):
+                offset = self._slot_offset(index)
+                seq, slot_pid, slot_tid, slot_label = self.slot_header.unpack_from(self._mmap, offset)
+                if slot_pid == pid and slot_tid == tid and slot_label.rstrip(b'\0') == label \
+                        or not is_alive(slot_pid):
+                    self.slot_header.pack_into(self._mmap, offset, seq + seq % 2, pid, tid, label)
+                    self.values_struct.pack_into(
+                        self._mmap, offset + self.slot_header.size, *[0.0] * self.values_count)
+                    return SharedMemorySlot(self, offset)
+        raise OverflowError(f'No free slots in {self.filename}')
+
+    def release(self, pid):
+        """
+        Frees all slots of process.
+        """
+        if self._mmap is None:
+            return
+        with _flock(self._fd):
+            for index in range(self.slots_count):
+                offset = self._slot_offset(index)
+                seq, slot_pid, _, _ = self.slot_header.unpack_from(self._mmap, offset)
+                if slot_pid == pid:
+                    self.slot_header.pack_into(self._mmap, offset, seq + seq % 2, 0, 0, b'')
+
+    def read(self) -> typing.Iterable[typing.Tuple[int, int, bytes, tuple]]:
+        """
+        Yields (pid, tid, label, values) of slots of alive processes.
+        """
+        self.open()
+        pids_alive = {}
+        for index in range(self.slots_count):
+            slot = self._read_slot(self._slot_offset(index))
+            if slot is None:
+                continue
+            pid = slot[0]
+            if pid not in pids_alive:
+                pids_alive[pid] = is_alive(pid)
+            if pids_alive[pid]:
+                yield slot
+
+    def _read_slot(self, offset):
+        for _ in range(READ_RETRIES):
+            seq, pid, tid, label = self.slot_header.unpack_from(self._mmap, offset)
+            if not pid:
+                return None
+            if seq % 2:
+                continue
+            values = self.values_struct.unpack_from(self._mmap, offset + self.slot_header.size)
+            if SEQ.unpack_from(self._mmap, offset)[0] == seq:
+                return pid, tid, label.rstrip(b'\0'), values
+        return None
+
+
+class SharedMemorySlot:
+    """
+    Must be written by one thread at a time.
+    """
+
+    def __init__(self, segment, offset):
+        self.segment = segment
+        self.offset = offset
+        self._values_offset = offset + segment.slot_header.size
+        self._seq = SEQ.unpack_from(segment._mmap, offset)[0]
+
+    def write(self, *values):
+        buf = self.segment._mmap
+        self._seq += 1
+        SEQ.pack_into(buf, self.offset, self._seq)
+        self.segment.values_struct.pack_into(buf, self._values_offset, *values)
+        self._seq += 1
+        SEQ.pack_into(buf, self.offset, self._seq)
+
+
+def is_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@contextlib.contextmanager
+def _flock(fd):
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)